@@ -1,112 +1,254 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import os
+import errno
 import time
 import hashlib
+import logging
+import orjson
+import mmap
+import sys
+import tempfile
+import subprocess
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from functools import lru_cache
 
 app = Flask(__name__)
 
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+)
+log = logging.getLogger(__name__)
+
 UPLOADS_DIR = '/app/uploads'
 CACHE_DIR = '/app/cache'
+# Scratch WAVs go to RAM-backed tmpfs when available; they are read back immediately
+TEMP_AUDIO_DIR = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else CACHE_DIR
+DIARIZATION_SAMPLE_RATE = 16000  # pyannote.audio models expect 16 kHz mono
+HASH_CHUNK_SIZE = 1024 * 1024  # 1 MiB per read when hashing audio files
+# Opt-in fp16 autocast on CUDA; leave unset if diarization quality regresses on a checkpoint
+PYANNOTE_FP16 = os.environ.get('PYANNOTE_FP16', '0') == '1'
+# Opt-in CUDA graph capture/replay of the segmentation model forward
+DIAR_CUDAGRAPH = os.environ.get('DIAR_CUDAGRAPH', '0') == '1'
+CUDAGRAPH_MAX_SHAPES = 8  # One captured graph per window shape; bounds extra GPU memory
+# Opt-in dynamic int8 quantization of the segmentation model for CPU-only hosts
+DIAR_INT8 = os.environ.get('DIAR_INT8', '0') == '1'
+# Windows per segmentation/embedding forward inside the pipeline (0 keeps the checkpoint default)
+DIAR_BATCH_SIZE = int(os.environ.get('DIAR_BATCH_SIZE', '0'))
+DIARIZATION_TIMEOUT = 300  # Seconds a request waits for its queued pipeline run
+
+pipeline = None
+pipeline_error = None
+pipeline_placed = False  # Per process: True once moved to this worker's device
+_pipeline_lock = threading.Lock()
 
 # Initialize pyannote.audio pipeline
 try:
     from pyannote.audio import Pipeline
     import torch
+    import torchaudio
+    from torch.ao.quantization import quantize_dynamic
     
     # Use a pre-trained pipeline model
     # Note: In production, you may need to set HF_TOKEN environment variable
     # and accept model terms on HuggingFace
     PIPELINE_MODEL = "pyannote/speaker-diarization-3.1"
-    pipeline = None
     
-    def get_pipeline():
-        global pipeline
-        if pipeline is None:
+    def make_graphed_forward(forward):
+        """Wrap a single-tensor forward so repeated input shapes replay a captured CUDA graph
+        
+        pyannote slides fixed-size windows over the audio, so every full batch has
+        the same shape and only pays kernel launch overhead once, at capture time.
+        Graphs are keyed on the per-window shape; smaller (tail) batches are padded
+        into the largest captured batch and the output sliced back, so file length
+        never costs a new capture.
+        """
+        graphs = {}
+        
+        def graphed_forward(waveforms, *args, **kwargs):
+            if args or kwargs or not waveforms.is_cuda:
+                return forward(waveforms, *args, **kwargs)
+            if torch.is_autocast_enabled() and torch.is_autocast_cache_enabled():
+                # A capture would bake in cast-cache copies freed after this autocast block
+                return forward(waveforms)
+            
+            key = (tuple(waveforms.shape[1:]), waveforms.dtype)
+            batch_size = waveforms.shape[0]
+            entry = graphs.get(key, False)
+            if entry is None:
+                return forward(waveforms)
+            if entry is False or entry[1].shape[0] < batch_size:
+                if entry is False and len(graphs) >= CUDAGRAPH_MAX_SHAPES:
+                    return forward(waveforms)
+                # Drop a smaller graph for this window shape before capturing the larger one
+                graphs.pop(key, None)
+                try:
+                    static_input = waveforms.clone()
+                    # Warm up on a side stream before capture, as CUDA graphs require
+                    stream = torch.cuda.Stream()
+                    stream.wait_stream(torch.cuda.current_stream())
+                    with torch.cuda.stream(stream):
+                        for _ in range(3):
+                            forward(static_input)
+                    torch.cuda.current_stream().wait_stream(stream)
+                    graph = torch.cuda.CUDAGraph()
+                    with torch.cuda.graph(graph):
+                        static_output = forward(static_input)
+                    entry = graphs[key] = (graph, static_input, static_output)
+                except Exception as e:
+                    # e.g. a cuDNN kernel that can't be captured; don't retry this shape
+                    log.warning("CUDA graph capture failed for window shape %s, running eagerly: %s", key[0], e)
+                    graphs[key] = None
+                    return forward(waveforms)
+            
+            graph, static_input, static_output = entry
+            # Windows are independent, so stale rows past batch_size only pad the batch
+            static_input[:batch_size].copy_(waveforms)
+            graph.replay()
+            return static_output[:batch_size].clone()
+        
+        return graphed_forward
+    
+    def enable_cuda_graphs(loaded_pipeline):
+        """Route the segmentation model forward through CUDA graph replay"""
+        segmentation = getattr(loaded_pipeline, '_segmentation', None)
+        model = getattr(segmentation, 'model', None)
+        if model is None:
+            log.warning("DIAR_CUDAGRAPH=1 but pipeline has no segmentation model to capture")
+            return
+        model.forward = make_graphed_forward(model.forward)
+        log.info("CUDA graph replay enabled for segmentation model")
+    
+    def quantize_segmentation(loaded_pipeline):
+        """Swap the segmentation model's LSTM/Linear layers for dynamic int8 versions"""
+        segmentation = getattr(loaded_pipeline, '_segmentation', None)
+        model = getattr(segmentation, 'model', None)
+        if model is None:
+            log.warning("DIAR_INT8=1 but pipeline has no segmentation model to quantize")
+            return
+        quantize_dynamic(model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        log.info("Segmentation model quantized to int8 (check DER on a validation clip)")
+    
+    def load_pipeline():
+        """Load the pretrained pipeline and move it to the best available device"""
+        log.info("Loading pyannote.audio pipeline...")
+        # Get HuggingFace token from environment
+        hf_token = os.environ.get('HF_TOKEN')
+        
+        if hf_token:
+            log.info("Using HF_TOKEN for authentication (token length: %d)", len(hf_token))
+            # Try with use_auth_token (older API for huggingface_hub < 0.20.0)
             try:
-                print("Loading pyannote.audio pipeline...")
-                # Get HuggingFace token from environment
-                hf_token = os.environ.get('HF_TOKEN')
-                
-                if hf_token:
-                    print(f"Using HF_TOKEN for authentication (token length: {len(hf_token)})")
-                    # Try with use_auth_token (older API for huggingface_hub < 0.20.0)
-                    try:
-                        print("Attempting to load pipeline with use_auth_token...")
-                        pipeline = Pipeline.from_pretrained(PIPELINE_MODEL, use_auth_token=hf_token)
-                        print("Pipeline object created successfully")
-                    except TypeError as e:
-                        # Fallback to token parameter (newer API)
-                        print(f"Trying with 'token' parameter instead of 'use_auth_token': {e}")
-                        try:
-                            pipeline = Pipeline.from_pretrained(PIPELINE_MODEL, token=hf_token)
-                        except Exception as e2:
-                            error_msg = f"Failed to load pipeline with token parameter: {e2}"
-                            print(f"ERROR: {error_msg}")
-                            raise RuntimeError(error_msg)
-                    except Exception as e:
-                        # Provide more helpful error message
-                        error_msg = str(e)
-                        if "'NoneType' object has no attribute 'eval'" in error_msg or "NoneType" in error_msg:
-                            error_msg = (
-                                "Underlying model failed to load (returned None). "
-                                "The pyannote/speaker-diarization-3.1 pipeline requires several models. "
-                                "You MUST accept terms for ALL of these on HuggingFace:\n\n"
-                                "1. https://hf.co/pyannote/speaker-diarization-3.1\n"
-                                "2. https://hf.co/pyannote/segmentation-3.0 (likely the failing one)\n"
-                                "3. https://hf.co/pyannote/embedding\n"
-                                "4. https://hf.co/pyannote/speaker-diarization\n\n"
-                                "Visit each link, sign in with your HuggingFace account, "
-                                "and click 'Agree and access repository' for each one.\n"
-                                f"Original error: {e}"
-                            )
-                        else:
-                            error_msg = f"Failed to load pipeline: {e}"
-                        print(f"ERROR: {error_msg}")
-                        import traceback
-                        traceback.print_exc()
-                        raise RuntimeError(error_msg)
+                log.debug("Attempting to load pipeline with use_auth_token...")
+                loaded_pipeline = Pipeline.from_pretrained(PIPELINE_MODEL, use_auth_token=hf_token)
+                log.debug("Pipeline object created successfully")
+            except TypeError as e:
+                # Fallback to token parameter (newer API)
+                log.info("Trying with 'token' parameter instead of 'use_auth_token': %s", e)
+                try:
+                    loaded_pipeline = Pipeline.from_pretrained(PIPELINE_MODEL, token=hf_token)
+                except Exception as e2:
+                    error_msg = f"Failed to load pipeline with token parameter: {e2}"
+                    log.error("%s", error_msg)
+                    raise RuntimeError(error_msg)
+            except Exception as e:
+                # Provide more helpful error message
+                error_msg = str(e)
+                if "'NoneType' object has no attribute 'eval'" in error_msg or "NoneType" in error_msg:
+                    error_msg = (
+                        "Underlying model failed to load (returned None). "
+                        "The pyannote/speaker-diarization-3.1 pipeline requires several models. "
+                        "You MUST accept terms for ALL of these on HuggingFace:\n\n"
+                        "1. https://hf.co/pyannote/speaker-diarization-3.1\n"
+                        "2. https://hf.co/pyannote/segmentation-3.0 (likely the failing one)\n"
+                        "3. https://hf.co/pyannote/embedding\n"
+                        "4. https://hf.co/pyannote/speaker-diarization\n\n"
+                        "Visit each link, sign in with your HuggingFace account, "
+                        "and click 'Agree and access repository' for each one.\n"
+                        f"Original error: {e}"
+                    )
                 else:
-                    print("WARNING: No HF_TOKEN provided. Pipeline may require authentication.")
-                    print("Attempting to load without token (will likely fail for gated models)...")
-                    pipeline = Pipeline.from_pretrained(PIPELINE_MODEL)
-                
-                # Verify pipeline was actually loaded
-                if pipeline is None:
-                    raise RuntimeError("Pipeline.from_pretrained returned None - this usually means you need to accept the model terms at https://hf.co/pyannote/speaker-diarization-3.1")
-                
-                if torch.cuda.is_available():
-                    pipeline = pipeline.to(torch.device("cuda"))
-                print("Pipeline loaded successfully")
+                    error_msg = f"Failed to load pipeline: {e}"
+                log.exception("%s", error_msg)
+                raise RuntimeError(error_msg)
+        else:
+            log.warning("No HF_TOKEN provided. Pipeline may require authentication.")
+            log.warning("Attempting to load without token (will likely fail for gated models)...")
+            loaded_pipeline = Pipeline.from_pretrained(PIPELINE_MODEL)
+        
+        # Verify pipeline was actually loaded
+        if loaded_pipeline is None:
+            raise RuntimeError("Pipeline.from_pretrained returned None - this usually means you need to accept the model terms at https://hf.co/pyannote/speaker-diarization-3.1")
+        
+        if DIAR_BATCH_SIZE > 0:
+            if hasattr(loaded_pipeline, 'segmentation_batch_size'):
+                loaded_pipeline.segmentation_batch_size = DIAR_BATCH_SIZE
+            if hasattr(loaded_pipeline, 'embedding_batch_size'):
+                loaded_pipeline.embedding_batch_size = DIAR_BATCH_SIZE
+        
+        if DIAR_INT8 and not torch.cuda.is_available():
+            quantize_segmentation(loaded_pipeline)
+        
+        log.info("Pipeline loaded successfully")
+        return loaded_pipeline
+    
+    def place_pipeline(loaded_pipeline):
+        """Move a CPU-loaded pipeline onto this process's GPU, if there is one"""
+        if torch.cuda.is_available():
+            loaded_pipeline = loaded_pipeline.to(torch.device("cuda"))
+            if DIAR_CUDAGRAPH:
+                enable_cuda_graphs(loaded_pipeline)
+            log.info("Pipeline moved to CUDA in process %d", os.getpid())
+        return loaded_pipeline
+    
+    def _ensure_pipeline_loaded():
+        global pipeline, pipeline_error
+        if pipeline is None:
+            try:
+                pipeline = load_pipeline()
+                pipeline_error = None
             except Exception as e:
-                print(f"ERROR: Failed to load diarization pipeline: {e}")
-                import traceback
-                traceback.print_exc()
-                pipeline = None  # Explicitly set to None on error
+                log.exception("Failed to load diarization pipeline: %s", e)
+                pipeline_error = str(e)
+    
+    def preload_pipeline():
+        """Load the weights on CPU before gunicorn forks (see gunicorn.conf.py)
+        
+        Workers inherit the tensors copy-on-write instead of each loading its
+        own copy. CUDA must not be initialised before fork, so the move to the
+        GPU is left to each worker's first get_pipeline() call.
+        """
+        with _pipeline_lock:
+            _ensure_pipeline_loaded()
+        return pipeline
+    
+    def get_pipeline():
+        """Return the shared pipeline, loading it on first use
+        
+        Loading is deferred until a request needs the model, so worker boot and
+        /health stay cheap. The lock keeps concurrent first requests from racing
+        to load a second copy.
+        """
+        global pipeline, pipeline_placed
+        if pipeline is not None and pipeline_placed:
+            return pipeline
+        with _pipeline_lock:
+            _ensure_pipeline_loaded()
+            if pipeline is not None and not pipeline_placed:
+                try:
+                    pipeline = place_pipeline(pipeline)
+                except Exception as e:
+                    log.warning("Failed to move pipeline to GPU, staying on CPU: %s", e)
+                pipeline_placed = True
         return pipeline
 except ImportError:
-    print("WARNING: pyannote.audio not available, falling back to mock")
+    log.warning("pyannote.audio not available, falling back to mock")
     Pipeline = None
 
-# Try to load pipeline on module import (when gunicorn starts)
-print("=" * 60)
-print("Diarization service module loaded")
-print("=" * 60)
-if Pipeline is not None:
-    print("Attempting to pre-load pipeline...")
-    try:
-        # This will trigger pipeline loading
-        test_pipeline = get_pipeline()
-        if test_pipeline is None:
-            print("ERROR: Pipeline is None after get_pipeline() call")
-        else:
-            print("SUCCESS: Pipeline pre-loaded successfully")
-    except Exception as e:
-        print(f"ERROR: Failed to pre-load pipeline: {e}")
-        import traceback
-        traceback.print_exc()
-else:
-    print("WARNING: Pipeline class is None (pyannote.audio not available)")
-print("=" * 60)
+log.info("Diarization service module loaded (pipeline loads on first /process)")
 
 @app.route('/health', methods=['GET'])
 def health():
@@ -116,14 +258,12 @@ def health():
     
     if Pipeline is None:
         status = 'degraded (pyannote.audio not available)'
-    else:
-        # Try to get the pipeline to see if it's actually loaded
-        pipeline = get_pipeline()
-        if pipeline is None:
-            status = 'degraded (pipeline failed to load)'
-            error = 'Pipeline loading failed. Check service logs for details.'
-        else:
-            pipeline_loaded = True
+    elif pipeline is not None:
+        pipeline_loaded = True
+    elif pipeline_error is not None:
+        # Don't trigger a load here; the pipeline is loaded lazily by /process
+        status = 'degraded (pipeline failed to load)'
+        error = f'Pipeline loading failed: {pipeline_error}. Check service logs for details.'
     
     return jsonify({
         'status': status, 
@@ -132,47 +272,201 @@ def health():
         'error': error
     })
 
-def compute_file_hash(file_path):
-    """Compute SHA-256 hash of file"""
-    sha256_hash = hashlib.sha256()
+# Digest memo keyed by (inode, size, mtime_ns) so unchanged uploads are not re-read;
+# LRU-bounded so a long-running worker doesn't keep one entry per upload forever
+HASH_CACHE_MAX_ENTRIES = 1024
+_hash_cache = OrderedDict()
+_hash_cache_lock = threading.Lock()
+
+def compute_file_hash(file_path, st=None):
+    """Compute BLAKE2b hash of file (used only as a cache key)
+
+    Pass the file's os.stat_result as st if the caller already has one.
+    """
+    if st is None:
+        st = os.stat(file_path)
+    key = (st.st_ino, st.st_size, st.st_mtime_ns)
+    with _hash_cache_lock:
+        file_hash = _hash_cache.get(key)
+        if file_hash is not None:
+            _hash_cache.move_to_end(key)
+            return file_hash
+    
+    file_hash = _hash_file(file_path, st.st_size)
+    with _hash_cache_lock:
+        _hash_cache[key] = file_hash
+        while len(_hash_cache) > HASH_CACHE_MAX_ENTRIES:
+            _hash_cache.popitem(last=False)
+    return file_hash
+
+def _hash_file(file_path, file_size):
     with open(file_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
+        # Map the file and hash it in one update() straight from the page cache.
+        # Empty files can't be mapped, and 32-bit builds can't map >2 GB.
+        if 0 < file_size < sys.maxsize:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return hashlib.blake2b(mm).hexdigest()
+            except (OSError, ValueError, OverflowError):
+                pass
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+: read/update loop runs entirely in C
+            return hashlib.file_digest(f, hashlib.blake2b).hexdigest()
+        file_hash = hashlib.blake2b()
+        # Reuse one buffer so each chunk costs a readinto() and no allocation
+        buf = bytearray(HASH_CHUNK_SIZE)
+        view = memoryview(buf)
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            file_hash.update(view[:size])
+    return file_hash.hexdigest()
 
-def get_cached_result(audio_file_id):
-    """Check cache for existing diarization result"""
+@lru_cache(maxsize=64)
+def _load_cache_file(cache_path):
+    """Read a cache entry once; entries are content-addressed so never go stale
+    
+    The raw JSON bytes are kept and sent back as-is on a hit. They are parsed
+    once here (orjson, a single C call) only to reject corrupt entries.
+    """
+    with open(cache_path, 'rb') as f:
+        payload = f.read()
+    orjson.loads(payload)
+    return payload
+
+def get_cached_result(audio_path):
+    """Check cache for existing diarization result
+
+    Returns (result, file_hash); file_hash is passed on to save_cached_result
+    so a cache miss does not hash the audio file a second time.
+    Raises FileNotFoundError if the audio file itself does not exist.
+    """
+    st = os.stat(audio_path)
+    file_hash = None
     try:
-        audio_path = os.path.join(UPLOADS_DIR, audio_file_id)
-        if not os.path.exists(audio_path):
-            return None
-        
-        file_hash = compute_file_hash(audio_path)
+        file_hash = compute_file_hash(audio_path, st)
         cache_path = os.path.join(CACHE_DIR, 'diarization', f'{file_hash}.json')
-        
-        if os.path.exists(cache_path):
-            import json
-            with open(cache_path, 'r') as f:
-                return json.load(f)
+        # Open directly; a missing entry is just a miss, no exists() probe first
+        return _load_cache_file(cache_path), file_hash
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        print(f"Error reading cache: {e}")
-    return None
+        log.warning("Error reading cache: %s", e)
+    return None, file_hash
 
-def save_cached_result(audio_file_id, result):
-    """Save diarization result to cache"""
+def save_cached_result(file_hash, payload):
+    """Save serialized diarization result (JSON bytes) to cache"""
+    if file_hash is None:
+        return
     try:
-        audio_path = os.path.join(UPLOADS_DIR, audio_file_id)
-        file_hash = compute_file_hash(audio_path)
         cache_dir = os.path.join(CACHE_DIR, 'diarization')
         os.makedirs(cache_dir, exist_ok=True)
         
         cache_path = os.path.join(cache_dir, f'{file_hash}.json')
-        import json
-        with open(cache_path, 'w') as f:
-            json.dump(result, f, indent=2)
-        print(f"Cached diarization result: {cache_path}")
+        # Write then rename so a reader never sees a partial entry
+        temp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(temp_path, cache_path)
+        log.info("Cached diarization result: %s", cache_path)
+    except Exception as e:
+        log.warning("Error saving cache: %s", e)
+
+def load_waveform(audio_path):
+    """Decode audio in-process to a 16 kHz mono (channel, time) tensor for pyannote.audio"""
+    try:
+        waveform, sample_rate = torchaudio.load(audio_path)
     except Exception as e:
-        print(f"Error saving cache: {e}")
+        # Containers torchaudio's backend can't read still go through ffmpeg
+        log.info("torchaudio could not decode %s (%s), converting with ffmpeg...", audio_path, e)
+        waveform, sample_rate = load_waveform_with_ffmpeg(audio_path)
+    
+    if sample_rate != DIARIZATION_SAMPLE_RATE:
+        waveform = torchaudio.functional.resample(waveform, sample_rate, DIARIZATION_SAMPLE_RATE)
+    if waveform.shape[0] > 1:
+        waveform = waveform.mean(dim=0, keepdim=True)
+    return waveform, DIARIZATION_SAMPLE_RATE
+
+def load_waveform_with_ffmpeg(audio_path):
+    """Convert audio to a temporary 16 kHz mono WAV with ffmpeg and load it
+    
+    Long inputs can outgrow a small /dev/shm (Docker defaults to 64 MB); the
+    conversion is then redone in CACHE_DIR on disk.
+    """
+    try:
+        return convert_and_load(audio_path, TEMP_AUDIO_DIR)
+    except subprocess.CalledProcessError as e:
+        if TEMP_AUDIO_DIR == CACHE_DIR or b'No space left on device' not in (e.stderr or b''):
+            raise
+    except OSError as e:
+        if TEMP_AUDIO_DIR == CACHE_DIR or e.errno != errno.ENOSPC:
+            raise
+    log.warning("%s is full, converting %s in %s instead", TEMP_AUDIO_DIR, audio_path, CACHE_DIR)
+    return convert_and_load(audio_path, CACHE_DIR)
+
+def convert_and_load(audio_path, temp_dir):
+    """ffmpeg audio_path to a 16 kHz mono WAV in temp_dir, load it, delete it"""
+    with tempfile.NamedTemporaryFile(dir=temp_dir, prefix='temp_diarization_', suffix='.wav', delete=False) as tmp:
+        temp_wav_path = tmp.name
+    try:
+        subprocess.run([
+            'ffmpeg', '-threads', '0', '-i', audio_path,
+            '-ar', str(DIARIZATION_SAMPLE_RATE),  # Resample to 16kHz (pyannote.audio standard)
+            '-ac', '1',      # Mono
+            '-f', 'wav',
+            '-y',            # Overwrite output
+            temp_wav_path
+        ], check=True, capture_output=True)
+        return torchaudio.load(temp_wav_path)
+    finally:
+        if os.path.exists(temp_wav_path):
+            try:
+                os.unlink(temp_wav_path)
+            except OSError:
+                pass
+
+# Pipeline runs are funnelled through one consumer thread that owns the model,
+# so request threads decode/hash concurrently while the GPU stays busy
+_diarization_queue = queue.Queue()
+_diarization_worker = None
+_diarization_worker_lock = threading.Lock()
+
+def _run_diarization_queue():
+    while True:
+        audio, future = _diarization_queue.get()
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            diarization_pipeline = get_pipeline()
+            if diarization_pipeline is None:
+                raise RuntimeError('Diarization pipeline failed to load. Check service logs for details.')
+            # No autograd bookkeeping; optional fp16 autocast on GPU (PYANNOTE_FP16=1).
+            # Captured graphs must not point into autocast's weight cast cache,
+            # which is freed when the block exits
+            use_fp16 = PYANNOTE_FP16 and torch.cuda.is_available()
+            with torch.inference_mode(), torch.autocast('cuda', dtype=torch.float16, enabled=use_fp16, cache_enabled=not DIAR_CUDAGRAPH):
+                future.set_result(diarization_pipeline(audio))
+        except Exception as e:
+            future.set_exception(e)
+
+def run_diarization(audio):
+    """Queue a pipeline run and block until the consumer thread finishes it"""
+    global _diarization_worker
+    # Started lazily so the thread belongs to the serving process, not a pre-fork parent
+    with _diarization_worker_lock:
+        if _diarization_worker is None or not _diarization_worker.is_alive():
+            _diarization_worker = threading.Thread(target=_run_diarization_queue, daemon=True)
+            _diarization_worker.start()
+    
+    future = Future()
+    _diarization_queue.put((audio, future))
+    try:
+        return future.result(timeout=DIARIZATION_TIMEOUT)
+    except FutureTimeoutError:
+        # Still queued: the consumer skips it instead of running it for nobody
+        future.cancel()
+        raise
 
 @app.route('/process', methods=['POST'])
 def process():
@@ -188,22 +482,23 @@ def process():
         if not audio_file_id:
             return jsonify({'error': 'audioFileId is required'}), 400
         
-        print(f"Processing diarization for job {job_id}, audio: {audio_file_id}")
-        
-        # Check cache first
-        cached_result = get_cached_result(audio_file_id)
-        if cached_result:
-            print(f"Using cached diarization result for job {job_id}")
-            return jsonify(cached_result)
+        log.info("Processing diarization for job %s, audio: %s", job_id, audio_file_id)
         
         audio_path = os.path.join(UPLOADS_DIR, audio_file_id)
-        if not os.path.exists(audio_path):
+        
+        # Check cache first (this also stats the audio file once)
+        try:
+            cached_result, file_hash = get_cached_result(audio_path)
+        except FileNotFoundError:
             return jsonify({'error': f'Audio file not found: {audio_file_id}'}), 404
+        if cached_result:
+            log.info("Using cached diarization result for job %s", job_id)
+            return Response(cached_result, mimetype='application/json')
         
         # Perform diarization
         if Pipeline is None:
             # Fallback to mock if pyannote.audio not available
-            print("WARNING: Using mock diarization (pyannote.audio not available)")
+            log.warning("Using mock diarization (pyannote.audio not available)")
             time.sleep(2)
             result = {
                 'jobId': job_id,
@@ -218,53 +513,28 @@ def process():
             }
         else:
             # Real diarization with pyannote.audio
-            print(f"Running pyannote.audio diarization on {audio_path}")
+            log.info("Running pyannote.audio diarization on %s", audio_path)
             diarization_pipeline = get_pipeline()
             if diarization_pipeline is None:
                 error_msg = 'Diarization pipeline failed to load. Check service logs for details.'
-                print(f"ERROR: {error_msg}")
-                print("Pipeline is None - this means get_pipeline() returned None")
+                log.error("%s Pipeline is None - this means get_pipeline() returned None", error_msg)
                 return jsonify({'error': error_msg}), 500
             
-            # Convert audio to WAV if needed (pyannote.audio works better with WAV, especially for MP3)
-            import subprocess
-            temp_wav_path = None
             try:
-                audio_ext = os.path.splitext(audio_path)[1].lower()
-                if audio_ext != '.wav':
-                    # Convert to WAV using ffmpeg
-                    temp_wav_path = os.path.join(CACHE_DIR, f'temp_diarization_{int(time.time())}.wav')
-                    print(f"Converting {audio_ext} to WAV for diarization...")
-                    subprocess.run([
-                        'ffmpeg', '-i', audio_path,
-                        '-ar', '16000',  # Resample to 16kHz (pyannote.audio standard)
-                        '-ac', '1',      # Mono
-                        '-y',            # Overwrite output
-                        temp_wav_path
-                    ], check=True, capture_output=True)
-                    audio_path = temp_wav_path
-                    print(f"Audio converted to WAV: {temp_wav_path}")
+                # Decode in-process and hand pyannote.audio the tensor directly
+                waveform, sample_rate = load_waveform(audio_path)
                 
-                print(f"Calling diarization pipeline on {audio_path}")
-                diarization = diarization_pipeline(audio_path)
-                print(f"Diarization pipeline completed, processing results...")
+                log.debug("Calling diarization pipeline on %s", audio_path)
+                diarization = run_diarization({'waveform': waveform, 'sample_rate': sample_rate})
+                log.debug("Diarization pipeline completed, processing results...")
             except subprocess.CalledProcessError as e:
                 error_msg = f"FFmpeg conversion failed: {e.stderr.decode() if e.stderr else str(e)}"
-                print(f"ERROR: {error_msg}")
+                log.error("%s", error_msg)
                 return jsonify({'error': error_msg}), 500
             except Exception as pipeline_error:
                 error_msg = f"Error running diarization pipeline: {str(pipeline_error)}"
-                print(f"ERROR: {error_msg}")
-                import traceback
-                traceback.print_exc()
+                log.exception("%s", error_msg)
                 return jsonify({'error': error_msg}), 500
-            finally:
-                # Clean up temporary WAV file if created
-                if temp_wav_path and os.path.exists(temp_wav_path):
-                    try:
-                        os.unlink(temp_wav_path)
-                    except:
-                        pass
             
             # Convert pyannote.audio output to our format
             segments = []
@@ -282,18 +552,17 @@ def process():
             }
         
         # Save to cache
-        save_cached_result(audio_file_id, result)
+        # Serialize once for both the cache entry and the response body
+        payload = orjson.dumps(result)
+        save_cached_result(file_hash, payload)
         
-        print(f"Diarization completed for job {job_id}: {len(result['segments'])} segments")
+        log.info("Diarization completed for job %s: %d segments", job_id, len(result['segments']))
         
-        return jsonify(result)
+        return Response(payload, mimetype='application/json')
     
     except Exception as e:
         error_msg = f"Error in diarization: {str(e)}"
-        print(f"ERROR: {error_msg}")
-        import traceback
-        print("Full traceback:")
-        traceback.print_exc()
+        log.exception("%s", error_msg)
         return jsonify({
             'error': error_msg,
             'type': type(e).__name__
@@ -301,22 +570,17 @@ def process():
 
 # Try to load pipeline on startup to catch errors early
 if __name__ == '__main__':
-    print("=" * 60)
-    print("Diarization service starting...")
-    print("=" * 60)
+    log.info("Diarization service starting...")
     if Pipeline is not None:
-        print("Attempting to load pipeline on startup...")
+        log.info("Attempting to load pipeline on startup...")
         try:
             test_pipeline = get_pipeline()
             if test_pipeline is None:
-                print("WARNING: Pipeline is None after get_pipeline() call")
+                log.warning("Pipeline is None after get_pipeline() call")
             else:
-                print("SUCCESS: Pipeline loaded on startup")
+                log.info("Pipeline loaded on startup")
         except Exception as e:
-            print(f"ERROR: Failed to load pipeline on startup: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("Failed to load pipeline on startup: %s", e)
     else:
-        print("WARNING: Pipeline class is None (pyannote.audio not available)")
-    print("=" * 60)
+        log.warning("Pipeline class is None (pyannote.audio not available)")
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,18 @@
+# Gunicorn configuration for the diarization service
+#
+# The pyannote pipeline is loaded once in the master, on CPU, before workers
+# are forked. Workers then share the weight pages copy-on-write instead of
+# each holding a private copy. On GPU hosts each worker moves the pipeline to
+# CUDA on its first request (CUDA can't be initialised before fork).
+
+preload_app = True
+
+
+def when_ready(server):
+    import app
+
+    if app.Pipeline is None:
+        return
+    server.log.info("Pre-loading diarization pipeline in master (pid %s)", server.pid)
+    if app.preload_pipeline() is None:
+        server.log.warning("Pipeline pre-load failed; workers will retry on first request")
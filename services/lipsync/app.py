@@ -1,8 +1,13 @@
 from flask import Flask, request, jsonify
+import math
 import time
+import numpy as np
 
 app = Flask(__name__)
 
+KEYFRAME_INTERVAL = 0.1  # Seconds between mock keyframes
+MOUTH_SHAPES = np.array(['A', 'E', 'I', 'O', 'U'])
+
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({'status': 'healthy', 'service': 'lipsync'})
@@ -34,15 +39,17 @@ def process():
             end = segment['end']
             duration = end - start
             
-            # Generate mock keyframes (phoneme/viseme data)
-            keyframes = []
-            current_time = start
-            while current_time < end:
-                keyframes.append({
-                    'time': current_time,
-                    'mouth_shape': ['A', 'E', 'I', 'O', 'U'][int(current_time * 10) % 5]
-                })
-                current_time += 0.1
+            # Generate mock keyframes (phoneme/viseme data), one every 0.1s.
+            # Sequential accumulation gives bit-identical times to stepping
+            # t += KEYFRAME_INTERVAL, and the mask keeps every time below end
+            steps = max(math.ceil((end - start) / KEYFRAME_INTERVAL) + 1, 0)
+            times = np.add.accumulate(np.concatenate(([start], np.full(steps, KEYFRAME_INTERVAL))))
+            times = times[times < end]
+            shapes = MOUTH_SHAPES[(times * 10).astype(np.int64) % len(MOUTH_SHAPES)]
+            keyframes = [
+                {'time': t, 'mouth_shape': shape}
+                for t, shape in zip(times.tolist(), shapes.tolist())
+            ]
             
             lipsync_data.append({
                 'speaker': speaker_name,
@@ -2,7 +2,8 @@ from flask import Flask, request, jsonify
 import os
 import time
 import subprocess
-import glob
+import struct
+import threading
 
 app = Flask(__name__)
 
@@ -14,6 +15,101 @@ DEFAULT_FPS = 30
 DEFAULT_RESOLUTION = '1920x1080'
 DEFAULT_VIDEO_CODEC = 'libx264'
 DEFAULT_AUDIO_CODEC = 'aac'
+RAW_PIXEL_FORMAT = 'rgb24'  # Layout of raw frame streams passed as videoFrames
+RAW_BYTES_PER_PIXEL = 3
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# H.264 encoders in order of preference; MUX_ENCODER overrides detection
+VIDEO_ENCODER_CANDIDATES = ['h264_nvenc', 'h264_qsv', 'h264_vaapi', DEFAULT_VIDEO_CODEC]
+VAAPI_DEVICE = os.environ.get('VAAPI_DEVICE', '/dev/dri/renderD128')
+VIDEO_ENCODER_OPTIONS = {
+    'h264_nvenc': ['-pix_fmt', 'yuv420p', '-preset', 'p4', '-rc', 'vbr', '-cq', '23', '-b:v', '0'],
+    'h264_qsv': ['-preset', 'medium', '-global_quality', '23'],
+    'h264_vaapi': ['-qp', '23'],
+    'libx264': ['-pix_fmt', 'yuv420p', '-crf', '23', '-preset', 'medium'],
+}
+video_encoder = None
+_video_encoder_lock = threading.Lock()
+
+# Request threads block in subprocess.run without holding the GIL, so one worker
+# can oversee several encodes; this caps how many ffmpeg processes run at once
+MAX_CONCURRENT_ENCODES = int(os.environ.get('MUX_MAX_CONCURRENT_ENCODES', os.cpu_count() or 1))
+encode_slots = threading.BoundedSemaphore(MAX_CONCURRENT_ENCODES)
+
+def encoder_global_args(encoder):
+    """Options that must come before the inputs for the given encoder"""
+    if encoder == 'h264_vaapi':
+        return ['-vaapi_device', VAAPI_DEVICE]
+    return []
+
+def encoder_filters(encoder):
+    """Filters appended to the chain to hand frames to the encoder"""
+    if encoder == 'h264_vaapi':
+        return ['format=nv12', 'hwupload']
+    if encoder == 'h264_qsv':
+        return ['format=nv12']
+    return []
+
+def probe_encoder(encoder):
+    """Check the encoder can actually run here (listed != hardware present)"""
+    filters = ','.join(encoder_filters(encoder)) or 'null'
+    try:
+        result = subprocess.run([
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            *encoder_global_args(encoder),
+            '-f', 'lavfi', '-i', 'color=size=256x256:duration=0.1',
+            '-vf', filters,
+            '-c:v', encoder,
+            '-f', 'null', '-'
+        ], capture_output=True, timeout=30)
+        return result.returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+def read_png_size(png_path):
+    """Read (width, height) from a PNG's IHDR chunk without decoding the image"""
+    try:
+        with open(png_path, 'rb') as f:
+            header = f.read(24)
+    except OSError:
+        return None
+    if len(header) < 24 or header[:8] != PNG_SIGNATURE or header[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', header[16:24])
+
+def get_video_encoder():
+    """Pick the video encoder once per process: MUX_ENCODER, else first working candidate"""
+    if video_encoder is not None:
+        return video_encoder
+    # Concurrent callers wait for the one detection run instead of probing too
+    with _video_encoder_lock:
+        if video_encoder is None:
+            detect_video_encoder()
+    return video_encoder
+
+def detect_video_encoder():
+    """MUX_ENCODER if set, else the first candidate that probes OK (libx264 fallback)"""
+    global video_encoder
+    encoder = os.environ.get('MUX_ENCODER')
+    if not encoder:
+        try:
+            available = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-encoders'],
+                capture_output=True, text=True, timeout=30
+            ).stdout
+        except (OSError, subprocess.TimeoutExpired):
+            available = ''
+        encoder = DEFAULT_VIDEO_CODEC
+        for candidate in VIDEO_ENCODER_CANDIDATES[:-1]:
+            if candidate in available and probe_encoder(candidate):
+                encoder = candidate
+                break
+    # Published only once final: get_video_encoder reads it without the lock
+    video_encoder = encoder
+    print(f"Using video encoder: {video_encoder}")
+
+# Probe at startup in the background so the first request doesn't pay for it
+threading.Thread(target=get_video_encoder, daemon=True).start()
 
 @app.route('/health', methods=['GET'])
 def health():
@@ -39,7 +135,7 @@ def process():
     try:
         data = request.json
         job_id = data.get('jobId')
-        video_frames = data.get('videoFrames')  # Path to frame directory
+        video_frames = data.get('videoFrames')  # Path to PNG frame directory, or raw rgb24 file/pipe
         audio_file_id = data.get('audioFileId')
         fps = data.get('fps', DEFAULT_FPS)
         resolution = data.get('resolution', DEFAULT_RESOLUTION)
@@ -56,27 +152,60 @@ def process():
         print(f"  FPS: {fps}, Resolution: {resolution}")
         
         # Resolve paths
-        frames_dir = video_frames
-        if not os.path.isabs(frames_dir):
-            frames_dir = os.path.join(OUTPUTS_DIR, frames_dir)
+        frames_path = video_frames
+        if not os.path.isabs(frames_path):
+            frames_path = os.path.join(OUTPUTS_DIR, frames_path)
         
         audio_path = os.path.join(UPLOADS_DIR, audio_file_id)
         
         # Validate inputs
-        if not os.path.exists(frames_dir):
-            return jsonify({'error': f'Frame directory not found: {frames_dir}'}), 404
+        if not os.path.exists(frames_path):
+            return jsonify({'error': f'Frame directory not found: {frames_path}'}), 404
         
         if not os.path.exists(audio_path):
             return jsonify({'error': f'Audio file not found: {audio_file_id}'}), 404
         
-        # Find frame files (PNG images)
-        frame_pattern = os.path.join(frames_dir, '*.png')
-        frame_files = sorted(glob.glob(frame_pattern))
-        
-        if len(frame_files) == 0:
-            return jsonify({'error': f'No frame files found in {frames_dir}'}), 404
+        # Parse resolution
+        width, height = map(int, resolution.split('x'))
         
-        print(f"Found {len(frame_files)} frame files")
+        if os.path.isdir(frames_path):
+            # Find numbered frame files (0000.png, 0001.png, ...) in one directory pass
+            with os.scandir(frames_path) as it:
+                frame_numbers = [
+                    int(entry.name[:-4]) for entry in it
+                    if entry.name.endswith('.png') and entry.name[:-4].isdigit()
+                ]
+            
+            if len(frame_numbers) == 0:
+                return jsonify({'error': f'No frame files found in {frames_path}'}), 404
+            
+            frame_count = len(frame_numbers)
+            print(f"Found {frame_count} frame files")
+            
+            # Check if frames are numbered starting from 0 or 1
+            frame_number = min(frame_numbers)
+            
+            video_input_args = ['-framerate', str(fps)]
+            # If frames don't start at 0000, add start_number (must precede -i)
+            if frame_number != 0:
+                video_input_args += ['-start_number', str(frame_number)]
+            video_input_args += ['-i', os.path.join(frames_path, '%04d.png')]
+            source_size = read_png_size(os.path.join(frames_path, f'{frame_number:04d}.png'))
+        else:
+            # Raw frames (regular file or named pipe) are read by ffmpeg as-is,
+            # skipping the PNG encode/decode and one open() per frame
+            video_input_args = [
+                '-f', 'rawvideo',
+                '-pixel_format', RAW_PIXEL_FORMAT,
+                '-video_size', f'{width}x{height}',
+                '-framerate', str(fps),
+                '-i', frames_path
+            ]
+            source_size = (width, height)
+            frame_count = None
+            if os.path.isfile(frames_path):
+                frame_count = os.path.getsize(frames_path) // (width * height * RAW_BYTES_PER_PIXEL)
+            print(f"Reading raw {RAW_PIXEL_FORMAT} frames from {frames_path}")
         
         # Create output directory
         output_dir = os.path.join(OUTPUTS_DIR, job_id)
@@ -84,55 +213,39 @@ def process():
         
         output_path = os.path.join(output_dir, 'final_video.mp4')
         
-        # Parse resolution
-        width, height = map(int, resolution.split('x'))
-        
         # Build FFmpeg command
-        # Use pattern for input frames
-        frame_pattern_input = os.path.join(frames_dir, '%04d.png')
-        
-        # Check if frames are numbered starting from 0 or 1
-        first_frame = frame_files[0]
-        frame_basename = os.path.basename(first_frame)
-        frame_number = int(os.path.splitext(frame_basename)[0])
-        
-        if frame_number == 0:
-            frame_pattern_input = os.path.join(frames_dir, '%04d.png')
+        encoder = get_video_encoder()
+        video_filters = encoder_filters(encoder)
+        # Only run swscale when frames aren't already at the target resolution
+        if source_size != (width, height):
+            video_filters = [f'scale={width}:{height}', *video_filters]
         else:
-            # Use start_number parameter
-            frame_pattern_input = os.path.join(frames_dir, '%04d.png')
-        
+            print("Frames already match target resolution, skipping scale filter")
         ffmpeg_cmd = [
             'ffmpeg',
             '-y',  # Overwrite output file
-            '-framerate', str(fps),
-            '-i', frame_pattern_input,
+            *encoder_global_args(encoder),
+            *video_input_args,
             '-i', audio_path,
-            '-c:v', DEFAULT_VIDEO_CODEC,
-            '-pix_fmt', 'yuv420p',
-            '-crf', '23',  # Quality setting (lower = better quality)
-            '-preset', 'medium',
+            '-c:v', encoder,
+            *VIDEO_ENCODER_OPTIONS.get(encoder, []),  # Quality/speed settings per encoder
             '-c:a', DEFAULT_AUDIO_CODEC,
             '-b:a', '192k',  # Audio bitrate
-            '-vf', f'scale={width}:{height}',
+            *(['-vf', ','.join(video_filters)] if video_filters else []),
             '-shortest',  # Finish encoding when shortest input ends
             output_path
         ]
         
-        # If frames don't start at 0000, add start_number
-        if frame_number != 0:
-            ffmpeg_cmd.insert(ffmpeg_cmd.index('-i') + 1, '-start_number')
-            ffmpeg_cmd.insert(ffmpeg_cmd.index('-start_number') + 1, str(frame_number))
-        
         print(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
         
-        # Execute FFmpeg
-        result = subprocess.run(
-            ffmpeg_cmd,
-            capture_output=True,
-            text=True,
-            timeout=600  # 10 minute timeout
-        )
+        # Execute FFmpeg (waits for a free encode slot first)
+        with encode_slots:
+            result = subprocess.run(
+                ffmpeg_cmd,
+                capture_output=True,
+                text=True,
+                timeout=600  # 10 minute timeout
+            )
         
         if result.returncode != 0:
             error_msg = result.stderr or result.stdout
@@ -153,11 +266,11 @@ def process():
             'jobId': job_id,
             'outputVideo': output_path,
             'format': 'mp4',
-            'codec': DEFAULT_VIDEO_CODEC,
+            'codec': encoder,
             'audioCodec': DEFAULT_AUDIO_CODEC,
             'fps': fps,
             'resolution': resolution,
-            'frameCount': len(frame_files),
+            'frameCount': frame_count,
             'fileSize': file_size,
             'processedAt': time.time()
         }
@@ -1,26 +1,52 @@
 from flask import Flask, request, jsonify
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 import os
 import time
 import json
 import pickle
+import shutil
+import subprocess
+import threading
+import traceback
 import numpy as np
 from pathlib import Path
 
 app = Flask(__name__)
+# Reject oversized profile samples before any of the body is read
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('SPEAKER_ID_MAX_UPLOAD_MB', '100')) * 1024 * 1024
 
 PROFILES_DIR = '/app/profiles'
 UPLOADS_DIR = '/app/uploads'
 CACHE_DIR = '/app/cache'
 CONFIDENCE_THRESHOLD = 0.7  # Minimum confidence to accept a match
+PROFILE_META_SUFFIX = '.meta.json'  # Metadata sidecar next to each <speaker>.npy profile
+PROFILE_SHARD = 'profiles.npz'  # All profiles stacked into one normalized matrix
+TARGET_SAMPLE_RATE = 16000  # Sample rate the speechbrain model expects
+EMBEDDING_CLIP_SEC = 3.0  # Audio per diarized speaker fed to the embedding model
+MIN_SEGMENT_SEC = 0.5  # Shorter segments are only used if nothing longer exists
+# fp16 autocast for the ECAPA forward pass when running on CUDA
+SPEAKER_ID_FP16 = os.environ.get('SPEAKER_ID_FP16', '1') == '1'
 
 # Configure file upload
+UPLOAD_COPY_BUFFER_SIZE = 1024 * 1024  # 1 MiB chunks when spooling uploads to disk
 ALLOWED_AUDIO_EXTENSIONS = {'wav', 'mp3', 'flac', 'ogg', 'm4a'}
 
+# Parsed profiles, reused until PROFILES_DIR's mtime changes. Profiles are
+# written with os.replace, so adding or updating one always bumps the mtime
+# (also for the other gunicorn workers).
+_profile_cache = {'mtime': None, 'matrix': None, 'names': None}
+
+# torchaudio Resample transforms keyed by (input sample rate, device type)
+_resamplers = {}
+
 # Initialize speaker recognition model
 SpeakerRecognition = None
+device = 'cpu'
+use_fp16 = False
 verification_model = None
 model_loading_error = None
+_model_lock = threading.Lock()
 
 try:
     # Try different import paths for different speechbrain versions
@@ -42,26 +68,37 @@ try:
                 raise ImportError(f"Could not find SpeakerRecognition class. Error: {e2}")
             except ImportError:
                 raise ImportError("speechbrain package not installed")
+    import torch
     import torchaudio
     print("SpeechBrain and torchaudio imported successfully")
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    use_fp16 = SPEAKER_ID_FP16 and device == 'cuda'
+    print(f"Speaker embeddings will run on {device}" + (" (fp16)" if use_fp16 else ""))
 except ImportError as e:
     print(f"WARNING: speechbrain not available: {e}")
     print("Falling back to mock mode - speaker profiles cannot be created from audio")
-    import traceback
     traceback.print_exc()
     SpeakerRecognition = None
     model_loading_error = f"Import error: {str(e)}"
 
 def get_verification_model():
     """Get or load the speaker recognition model"""
-    global verification_model, model_loading_error
-    
     if SpeakerRecognition is None:
         return None
     
     if verification_model is not None:
         return verification_model
     
+    # Only one thread (the warmup thread or a request) loads; the rest wait for it
+    with _model_lock:
+        if verification_model is None:
+            load_verification_model()
+        return verification_model
+
+def load_verification_model():
+    """Load the speaker recognition model (caller holds _model_lock)"""
+    global verification_model, model_loading_error
+    
     try:
         print("Loading speaker recognition model from HuggingFace...")
         print("Note: First load may take time to download the model (~100MB)")
@@ -72,15 +109,17 @@ def get_verification_model():
         
         verification_model = SpeakerRecognition.from_hparams(
             source="speechbrain/spkrec-ecapa-voxceleb",
-            savedir=savedir
+            savedir=savedir,
+            run_opts={"device": device}
         )
+        # Inference only: disable dropout/batch-norm updates
+        verification_model.eval()
         print("Speaker recognition model loaded successfully")
         model_loading_error = None
         return verification_model
     except Exception as e:
         error_msg = str(e)
         print(f"ERROR: Failed to load speaker recognition model: {error_msg}")
-        import traceback
         traceback.print_exc()
         
         # Provide more helpful error messages
@@ -94,6 +133,11 @@ def get_verification_model():
         verification_model = None
         return None
 
+# Warm the model in the background so the first request doesn't pay the
+# download/initialization on its own thread
+if SpeakerRecognition is not None:
+    threading.Thread(target=get_verification_model, name='model-warmup', daemon=True).start()
+
 @app.route('/health', methods=['GET'])
 def health():
     status = 'healthy'
@@ -101,6 +145,9 @@ def health():
     
     if SpeakerRecognition is None:
         status = 'degraded (speechbrain not available)'
+    elif verification_model is None and _model_lock.locked():
+        # Don't block the health check behind the warmup thread
+        status = 'degraded (model loading)'
     else:
         # Try to get the model to check if it's actually loaded
         model = get_verification_model()
@@ -117,123 +164,350 @@ def health():
     })
 
 def load_speaker_profiles():
-    """Load all speaker profiles from /profiles directory"""
-    profiles = {}
+    """Load all speaker profiles from /profiles directory
     
-    if not os.path.exists(PROFILES_DIR):
+    Returns (speaker_names, profile_matrix): profile_matrix is a contiguous
+    float32 (N, D) array whose rows are L2-normalized once here, so matching
+    is a single matrix-vector product. The result is cached in memory until
+    the directory changes; callers must not modify it.
+    """
+    try:
+        mtime = os.stat(PROFILES_DIR).st_mtime_ns
+    except FileNotFoundError:
         print(f"Profiles directory does not exist: {PROFILES_DIR}")
-        return profiles
+        return [], np.empty((0, 0), dtype=np.float32)
     
-    for filename in os.listdir(PROFILES_DIR):
-        if filename.endswith('.pkl') or filename.endswith('.json'):
-            speaker_name = os.path.splitext(filename)[0]
-            profile_path = os.path.join(PROFILES_DIR, filename)
-            
-            try:
-                if filename.endswith('.pkl'):
-                    with open(profile_path, 'rb') as f:
-                        profile_data = pickle.load(f)
-                else:
-                    with open(profile_path, 'r') as f:
-                        profile_data = json.load(f)
-                
-                # Extract embedding vector
-                if isinstance(profile_data, dict):
-                    embedding = profile_data.get('embedding', profile_data.get('vector'))
-                else:
-                    embedding = profile_data
-                
-                if embedding is not None:
-                    profiles[speaker_name] = np.array(embedding)
-                    print(f"Loaded profile for speaker: {speaker_name}")
-            except Exception as e:
-                print(f"Error loading profile {filename}: {e}")
+    if _profile_cache['mtime'] == mtime:
+        return _profile_cache['names'], _profile_cache['matrix']
+    
+    speaker_names, profile_matrix = read_speaker_profiles()
+    _profile_cache.update(mtime=mtime, names=speaker_names, matrix=profile_matrix)
+    return speaker_names, profile_matrix
+
+def invalidate_profile_cache():
+    _profile_cache['mtime'] = None
+
+def read_speaker_profiles():
+    """Read the profile shard, or rebuild it from the per-speaker files if it is stale"""
+    profile_files = list_profile_files()
+    # Stat before reading: a file replaced mid-read then just mismatches next time
+    file_stats = profile_file_stats(profile_files)
+    shard = load_profile_shard(profile_files, file_stats)
+    if shard is not None:
+        return shard
     
-    return profiles
+    speaker_names, profile_matrix = read_profile_files(profile_files)
+    write_profile_shard(profile_files, file_stats, speaker_names, profile_matrix)
+    return speaker_names, profile_matrix
+
+def list_profile_files():
+    """Map speaker name -> profile filename in PROFILES_DIR"""
+    # .npy profiles (written by save_speaker_profile) win over legacy
+    # .pkl/.json files for the same speaker
+    profile_files = {}
+    for filename in sorted(os.listdir(PROFILES_DIR)):
+        if filename.endswith(PROFILE_META_SUFFIX):
+            continue
+        speaker_name, ext = os.path.splitext(filename)
+        if ext == '.npy' or (ext in ('.pkl', '.json') and speaker_name not in profile_files):
+            profile_files[speaker_name] = filename
+    return profile_files
+
+def profile_file_stats(profile_files):
+    """(mtime_ns, size) per profile file, in sorted filename order"""
+    stats = []
+    for filename in sorted(profile_files.values()):
+        try:
+            st = os.stat(os.path.join(PROFILES_DIR, filename))
+            stats.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            stats.append((0, -1))  # Deleted since listing; never matches a shard
+    return np.array(stats, dtype=np.int64).reshape(-1, 2)
 
-def extract_segment_audio(audio_path, start_sec, end_sec):
-    """Extract audio segment from file"""
+def load_profile_shard(profile_files, file_stats):
+    """Load names and normalized matrix from PROFILE_SHARD in one read
+    
+    Returns None when the shard is missing, unreadable or was built from
+    different profile files: one added or deleted, or replaced in place
+    (e.g. a re-upload via the web UI), which changes its mtime or size.
+    """
+    shard_path = os.path.join(PROFILES_DIR, PROFILE_SHARD)
     try:
-        import torchaudio
-        import subprocess
-        
-        # Convert to WAV if needed (torchaudio may not support all formats)
-        audio_ext = os.path.splitext(audio_path)[1].lower()
-        temp_wav_path = None
-        
-        if audio_ext != '.wav':
-            # Convert to WAV using ffmpeg
-            temp_wav_path = os.path.join(CACHE_DIR, f'temp_segment_{int(time.time())}.wav')
-            print(f"Converting {audio_ext} to WAV for segment extraction...")
-            subprocess.run([
-                'ffmpeg', '-i', audio_path,
-                '-ar', '16000',  # Resample to 16kHz
-                '-ac', '1',      # Mono
-                '-y',            # Overwrite output
-                temp_wav_path
-            ], check=True, capture_output=True)
-            audio_path = temp_wav_path
-        
-        print(f"Loading audio file: {audio_path}")
-        waveform, sample_rate = torchaudio.load(audio_path)
-        print(f"Audio loaded: sample_rate={sample_rate}, waveform shape={waveform.shape}")
-        
-        start_sample = int(start_sec * sample_rate)
-        end_sample = int(end_sec * sample_rate)
-        
-        # Ensure we don't go beyond the audio length
-        if end_sample > waveform.shape[1]:
-            end_sample = waveform.shape[1]
-        if start_sample >= end_sample:
-            print(f"WARNING: Invalid segment range: {start_sample} >= {end_sample}")
-            return None, None
-        
-        segment = waveform[:, start_sample:end_sample]
-        print(f"Extracted segment: {start_sec:.2f}s - {end_sec:.2f}s ({end_sample - start_sample} samples)")
+        with np.load(shard_path) as shard:
+            if 'stats' not in shard.files or shard['files'].tolist() != sorted(profile_files.values()):
+                return None
+            if not np.array_equal(shard['stats'], file_stats):
+                return None
+            return shard['names'].tolist(), shard['matrix']
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Ignoring unreadable profile shard {shard_path}: {e}")
+        return None
+
+def write_profile_shard(profile_files, file_stats, speaker_names, profile_matrix):
+    """Atomically (re)write PROFILE_SHARD; failures only cost the next load a rescan"""
+    shard_path = os.path.join(PROFILES_DIR, PROFILE_SHARD)
+    tmp_path = f"{shard_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                files=np.array(sorted(profile_files.values()), dtype=str),
+                stats=file_stats,
+                names=np.array(speaker_names, dtype=str),
+                matrix=profile_matrix
+            )
+        os.replace(tmp_path, shard_path)
+    except Exception as e:
+        print(f"Error writing profile shard: {e}")
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+def read_profile_files(profile_files):
+    """Read and normalize every per-speaker profile file"""
+    speaker_names = []
+    embeddings = []
+    
+    for speaker_name, filename in profile_files.items():
+        profile_path = os.path.join(PROFILES_DIR, filename)
         
+        try:
+            if filename.endswith('.npy'):
+                # Memory-mapped float32 vector, no unpickling
+                profile_data = np.load(profile_path, mmap_mode='r')
+            elif filename.endswith('.pkl'):
+                with open(profile_path, 'rb') as f:
+                    profile_data = pickle.load(f)
+            else:
+                with open(profile_path, 'r') as f:
+                    profile_data = json.load(f)
+            
+            # Extract embedding vector
+            if isinstance(profile_data, dict):
+                embedding = profile_data.get('embedding', profile_data.get('vector'))
+            else:
+                embedding = profile_data
+            
+            if embedding is not None:
+                embedding = np.asarray(embedding, dtype=np.float32).ravel()
+                if embeddings and embedding.shape != embeddings[0].shape:
+                    print(f"Skipping profile {filename}: embedding size {embedding.size} != {embeddings[0].size}")
+                    continue
+                speaker_names.append(speaker_name)
+                embeddings.append(embedding)
+                print(f"Loaded profile for speaker: {speaker_name}")
+        except Exception as e:
+            print(f"Error loading profile {filename}: {e}")
+    
+    if not embeddings:
+        return speaker_names, np.empty((0, 0), dtype=np.float32)
+    
+    profile_matrix = np.stack(embeddings)
+    # Row norms via einsum: skips np.linalg.norm's dispatch/validation overhead
+    profile_matrix /= np.sqrt(np.einsum('ij,ij->i', profile_matrix, profile_matrix))[:, None] + 1e-8
+    return speaker_names, profile_matrix
+
+def load_audio_with_ffmpeg(audio_path):
+    """Fallback decode: ffmpeg to a temporary 16kHz mono WAV, then torchaudio
+    
+    The WAV comes back at TARGET_SAMPLE_RATE, so prepare_waveform won't
+    resample it a second time.
+    """
+    temp_wav_path = os.path.join(CACHE_DIR, f'temp_segment_{os.getpid()}_{time.time_ns()}.wav')
+    try:
+        subprocess.run([
+            'ffmpeg', '-i', audio_path,
+            '-vn',                   # Ignore cover art / video streams
+            '-c:a', 'pcm_s16le',     # Plain 16-bit PCM
+            '-ar', str(TARGET_SAMPLE_RATE),  # Resample to 16kHz
+            '-ac', '1',      # Mono
+            '-y',            # Overwrite output
+            temp_wav_path
+        ], check=True, capture_output=True)
+        return torchaudio.load(temp_wav_path)
+    finally:
         # Clean up temp file if created
-        if temp_wav_path and os.path.exists(temp_wav_path):
+        if os.path.exists(temp_wav_path):
             try:
                 os.unlink(temp_wav_path)
             except:
                 pass
-        
-        return segment, sample_rate
-    except subprocess.CalledProcessError as e:
-        error_msg = f"FFmpeg conversion failed: {e.stderr.decode() if e.stderr else str(e)}"
-        print(f"ERROR: {error_msg}")
-        return None, None
+
+def load_audio(audio_path):
+    """Decode a whole audio file into (waveform, sample_rate)"""
+    print(f"Loading audio file: {audio_path}")
+    # torchaudio's backends handle wav/mp3/flac/ogg directly; only spawn
+    # ffmpeg for what they can't decode
+    try:
+        waveform, sample_rate = torchaudio.load(audio_path)
     except Exception as e:
-        print(f"Error extracting audio segment: {e}")
-        import traceback
-        traceback.print_exc()
-        return None, None
+        print(f"torchaudio could not decode {audio_path} ({e}), converting with ffmpeg...")
+        waveform, sample_rate = load_audio_with_ffmpeg(audio_path)
+    print(f"Audio loaded: sample_rate={sample_rate}, waveform shape={waveform.shape}")
+    return waveform, sample_rate
 
-def compute_speaker_embedding(audio_path, start_sec, end_sec):
-    """Compute speaker embedding for a segment"""
-    if SpeakerRecognition is None:
+def slice_segment(waveform, sample_rate, start_sec, end_sec):
+    """Cut [start_sec, end_sec) out of an already loaded waveform (a view, no copy)"""
+    start_sample = int(start_sec * sample_rate)
+    end_sample = int(end_sec * sample_rate)
+    
+    # Ensure we don't go beyond the audio length
+    if end_sample > waveform.shape[1]:
+        end_sample = waveform.shape[1]
+    if start_sample >= end_sample:
+        print(f"WARNING: Invalid segment range: {start_sample} >= {end_sample}")
         return None
     
-    try:
-        segment, sample_rate = extract_segment_audio(audio_path, start_sec, end_sec)
-        if segment is None:
+    print(f"Extracted segment: {start_sec:.2f}s - {end_sec:.2f}s ({end_sample - start_sample} samples)")
+    return waveform[:, start_sample:end_sample]
+
+def build_speaker_clip(waveform, sample_rate, group_segments):
+    """Concatenate up to EMBEDDING_CLIP_SEC of a speaker's longest segments
+    
+    Diarization often emits sub-second fragments that give noisy embeddings;
+    a few seconds of the speaker's longest turns, joined into one clip, give a
+    stable embedding for the same single forward pass.
+    """
+    ordered = sorted(group_segments, key=lambda seg: seg.get('end', 0) - seg.get('start', 0), reverse=True)
+    target_samples = int(EMBEDDING_CLIP_SEC * sample_rate)
+    min_samples = int(MIN_SEGMENT_SEC * sample_rate)
+    pieces = []
+    total = 0
+    
+    for seg in ordered:
+        piece = slice_segment(waveform, sample_rate, seg.get('start', 0), seg.get('end', 0))
+        if piece is None:
+            continue
+        # Segments are longest-first, so once one is too short the rest are too
+        if pieces and piece.shape[-1] < min_samples:
+            break
+        piece = piece[:, :target_samples - total]
+        pieces.append(piece)
+        total += piece.shape[-1]
+        if total >= target_samples:
+            break
+    
+    if not pieces:
+        return None
+    return pieces[0] if len(pieces) == 1 else torch.cat(pieces, dim=-1)
+
+def get_resampler(orig_freq, target_device='cpu'):
+    """Resample transforms build their filter kernel on construction, so keep one
+    per input rate and device for the life of the process"""
+    key = (orig_freq, target_device)
+    resampler = _resamplers.get(key)
+    if resampler is None:
+        resampler = torchaudio.transforms.Resample(orig_freq, TARGET_SAMPLE_RATE).to(target_device)
+        _resamplers[key] = resampler
+    return resampler
+
+def prepare_waveform(waveform, sample_rate):
+    """Resample to TARGET_SAMPLE_RATE and downmix to a single [1, samples] row"""
+    # Resample to 16kHz if needed (speechbrain models typically expect 16kHz)
+    if sample_rate != TARGET_SAMPLE_RATE:
+        with torch.inference_mode():
+            waveform = get_resampler(sample_rate, waveform.device.type)(waveform)
+    
+    # The model treats rows as a batch, so downmix to one row
+    if waveform.dim() == 1:
+        waveform = waveform.unsqueeze(0)
+    elif waveform.shape[0] > 1:
+        waveform = waveform.mean(dim=0, keepdim=True)
+    return waveform
+
+def run_encode_batch(model, wavs, wav_lens=None):
+    """encode_batch on the model's device without autograd, fp16 autocast on CUDA"""
+    wavs = wavs.to(device, non_blocking=True)
+    if wav_lens is not None:
+        wav_lens = wav_lens.to(device, non_blocking=True)
+    with torch.inference_mode(), torch.autocast('cuda', dtype=torch.float16, enabled=use_fp16):
+        embeddings = model.encode_batch(wavs, wav_lens)
+    # One device-to-host copy for the whole batch
+    return embeddings.float().cpu()
+
+def encode_segments(segments, sample_rate):
+    """Embed several waveform segments with one padded encode_batch call
+    
+    Segments are zero-padded to the longest one and wav_lens (relative
+    lengths) tells the model where each row really ends. Returns a (K, D)
+    float32 array, or None if any segment could not be encoded.
+    """
+    model = get_verification_model()
+    if model is None:
+        return None
+    
+    # Only the short per-speaker clips go to the model's device, so resampling
+    # runs there too while the full decoded file stays in host memory
+    rows = [prepare_waveform(segment.to(device), sample_rate)[0] for segment in segments]
+    
+    if hasattr(model, 'encode_batch'):
+        try:
+            lengths = [row.shape[-1] for row in rows]
+            max_len = max(lengths)
+            batch = torch.zeros(len(rows), max_len, dtype=rows[0].dtype, device=rows[0].device)
+            for i, row in enumerate(rows):
+                batch[i, :lengths[i]] = row
+            wav_lens = torch.tensor(lengths, dtype=torch.float32) / max_len
+            
+            embeddings = run_encode_batch(model, batch, wav_lens)
+            return embeddings.numpy().reshape(len(rows), -1)
+        except Exception as e:
+            print(f"Batched encode_batch failed, encoding segments one by one: {e}")
+    
+    embeddings = []
+    for row in rows:
+        embedding = encode_waveform(row.unsqueeze(0), TARGET_SAMPLE_RATE)
+        if embedding is None:
             return None
-        
-        # Save segment to temp file for model
-        import tempfile
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp:
-            torchaudio.save(tmp.name, segment, sample_rate)
-            tmp_path = tmp.name
-        
+        embeddings.append(embedding)
+    return np.stack(embeddings)
+
+def encode_waveform(waveform, sample_rate):
+    """Create speaker embedding from an in-memory waveform tensor ([channels,] samples)"""
+    model = get_verification_model()
+    if model is None:
+        return None
+    
+    waveform = prepare_waveform(waveform, sample_rate)
+    
+    # Try different API methods
+    embedding = None
+    
+    # Method 1: Try encode_batch (most common)
+    if hasattr(model, 'encode_batch'):
         try:
-            # Use the same method as create_embedding_from_audio_file
-            embedding = create_embedding_from_audio_file(tmp_path)
-            return embedding
-        finally:
-            os.unlink(tmp_path)
-    except Exception as e:
-        print(f"Error computing embedding: {e}")
+            embedding = run_encode_batch(model, waveform)
+            if embedding.dim() > 1:
+                embedding = embedding.squeeze(0)
+        except Exception as e:
+            print(f"encode_batch failed: {e}")
+    
+    # Method 2: Try using the encoder module directly
+    if embedding is None and hasattr(model, 'mods'):
+        try:
+            # Access the encoder through the model's modules
+            encoder = model.mods.get('encoder', None)
+            if encoder is not None:
+                with torch.inference_mode():
+                    embedding = encoder(waveform.to(device))
+                if embedding.dim() > 1:
+                    embedding = embedding.squeeze(0)
+        except Exception as e:
+            print(f"Direct encoder access failed: {e}")
+    
+    if embedding is None:
         return None
+    
+    # Convert to numpy
+    if hasattr(embedding, 'detach'):
+        embedding = embedding.detach()
+    if hasattr(embedding, 'cpu'):
+        embedding = embedding.cpu()
+    if hasattr(embedding, 'numpy'):
+        embedding = embedding.numpy()
+    
+    return np.asarray(embedding, dtype=np.float32).ravel()
 
 def create_embedding_from_audio_file(audio_path):
     """Create speaker embedding from an entire audio file"""
@@ -245,160 +519,99 @@ def create_embedding_from_audio_file(audio_path):
         if model is None:
             return None
         
-        # Convert audio to WAV if needed (torchaudio may not support all formats)
-        import subprocess
-        import tempfile
-        
-        # Check if file needs conversion (not WAV)
-        audio_ext = os.path.splitext(audio_path)[1].lower()
-        temp_wav_path = None
-        
-        if audio_ext != '.wav':
-            # Convert to WAV using ffmpeg
-            temp_wav_path = os.path.join(CACHE_DIR, f'temp_convert_{int(time.time())}.wav')
-            try:
-                subprocess.run([
-                    'ffmpeg', '-i', audio_path,
-                    '-ar', '16000',  # Resample to 16kHz
-                    '-ac', '1',      # Mono
-                    '-y',            # Overwrite output
-                    temp_wav_path
-                ], check=True, capture_output=True)
-                audio_path = temp_wav_path
-            except subprocess.CalledProcessError as e:
-                print(f"FFmpeg conversion failed: {e.stderr.decode()}")
-                return None
-        else:
-            # Even for WAV, resample to 16kHz if needed
-            temp_wav_path = None
-        
-        # Load audio file
-        import torchaudio
-        waveform, sample_rate = torchaudio.load(audio_path)
-        
-        # Resample to 16kHz if needed (speechbrain models typically expect 16kHz)
-        if sample_rate != 16000:
-            resampler = torchaudio.transforms.Resample(sample_rate, 16000)
-            waveform = resampler(waveform)
-            sample_rate = 16000
-        
-        # Try different API methods
-        embedding = None
-        
-        # Method 1: Try encode_batch (most common)
-        if hasattr(model, 'encode_batch'):
-            try:
-                # Add batch dimension if needed
-                if waveform.dim() == 1:
-                    waveform = waveform.unsqueeze(0)
-                embedding = model.encode_batch(waveform)
-                if embedding.dim() > 1:
-                    embedding = embedding.squeeze(0)
-            except Exception as e:
-                print(f"encode_batch failed: {e}")
+        try:
+            waveform, sample_rate = load_audio(audio_path)
+        except subprocess.CalledProcessError as e:
+            print(f"FFmpeg conversion failed: {e.stderr.decode()}")
+            return None
+        embedding = encode_waveform(waveform, sample_rate)
         
-        # Method 2: Try encode_file (newer API)
+        # Fall back to encode_file (newer API), which reads the file itself
         if embedding is None and hasattr(model, 'encode_file'):
             try:
-                embedding = model.encode_file(audio_path)
+                with torch.inference_mode():
+                    embedding = model.encode_file(audio_path)
+                if hasattr(embedding, 'cpu'):
+                    embedding = embedding.cpu().numpy()
+                embedding = np.asarray(embedding, dtype=np.float32).ravel()
             except Exception as e:
                 print(f"encode_file failed: {e}")
-        
-        # Method 3: Try using the encoder module directly
-        if embedding is None and hasattr(model, 'mods'):
-            try:
-                # Access the encoder through the model's modules
-                encoder = model.mods.get('encoder', None)
-                if encoder is not None:
-                    # Prepare input
-                    if waveform.dim() == 1:
-                        waveform = waveform.unsqueeze(0)
-                    # Get embedding
-                    embedding = encoder(waveform)
-                    if embedding.dim() > 1:
-                        embedding = embedding.squeeze(0)
-            except Exception as e:
-                print(f"Direct encoder access failed: {e}")
+                embedding = None
         
         if embedding is None:
             print("All encoding methods failed. Available methods:", dir(model))
             return None
         
-        # Convert to numpy
-        if hasattr(embedding, 'cpu'):
-            embedding = embedding.cpu()
-        if hasattr(embedding, 'numpy'):
-            embedding = embedding.numpy()
-        elif hasattr(embedding, 'squeeze'):
-            embedding = embedding.squeeze()
-        
-        return np.array(embedding)
+        return embedding
     except Exception as e:
         print(f"Error creating embedding from audio file: {e}")
-        import traceback
         traceback.print_exc()
         return None
-    finally:
-        # Clean up temporary WAV file if created
-        if 'temp_wav_path' in locals() and temp_wav_path and os.path.exists(temp_wav_path):
-            try:
-                os.unlink(temp_wav_path)
-            except:
-                pass
 
 def save_speaker_profile(speaker_name, embedding):
     """Save speaker profile to disk"""
     if not os.path.exists(PROFILES_DIR):
         os.makedirs(PROFILES_DIR, exist_ok=True)
     
-    # Save as pickle (more efficient for numpy arrays)
-    profile_path = os.path.join(PROFILES_DIR, f"{secure_filename(speaker_name)}.pkl")
+    # Raw float32 .npy (loaded memory-mapped) plus a small JSON sidecar for metadata
+    base_path = os.path.join(PROFILES_DIR, secure_filename(speaker_name))
+    profile_path = f"{base_path}.npy"
+    meta_path = f"{base_path}{PROFILE_META_SUFFIX}"
     
-    profile_data = {
+    profile_meta = {
         'speaker_name': speaker_name,
-        'embedding': embedding.tolist(),  # Convert numpy array to list for JSON compatibility
         'created_at': time.time()
     }
     
     try:
-        with open(profile_path, 'wb') as f:
-            pickle.dump(profile_data, f)
+        # Write then rename, so readers never see a partial file and the
+        # directory mtime (the profile cache key) changes on every save
+        tmp_path = f"{base_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(profile_meta, f)
+        os.replace(tmp_path, meta_path)
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.asarray(embedding, dtype=np.float32).ravel())
+        os.replace(tmp_path, profile_path)
+        
+        # Drop a legacy pickle for the same speaker so it can't shadow the new profile
+        legacy_path = f"{base_path}.pkl"
+        if os.path.exists(legacy_path):
+            os.unlink(legacy_path)
+        
+        # Refresh the stacked shard so the next load is a single read
+        profile_files = list_profile_files()
+        file_stats = profile_file_stats(profile_files)
+        write_profile_shard(profile_files, file_stats, *read_profile_files(profile_files))
+        
+        invalidate_profile_cache()
         print(f"Saved speaker profile: {profile_path}")
         return profile_path
     except Exception as e:
         print(f"Error saving profile: {e}")
         return None
 
-def match_speaker(embedding, profiles):
-    """Match embedding to known speaker profiles"""
-    if embedding is None or len(profiles) == 0:
-        return None, 0.0
-    
-    # Ensure embedding is 1D
-    embedding = np.array(embedding)
-    if embedding.ndim > 1:
-        embedding = embedding.flatten()
+def match_speakers(query_matrix, speaker_names, profile_matrix):
+    """Match a (K, D) matrix of embeddings against all profiles with one (K, N) GEMM
     
-    best_match = None
-    best_score = 0.0
+    Returns a list of (speaker_name, confidence) per query row, with
+    (None, 0.0) for rows whose best cosine similarity is not positive.
+    """
+    if len(speaker_names) == 0:
+        return [(None, 0.0)] * len(query_matrix)
     
-    # Compute cosine similarity with each profile
-    embedding_norm = embedding / (np.linalg.norm(embedding) + 1e-8)
+    queries = np.asarray(query_matrix, dtype=np.float32)
+    queries = queries / (np.sqrt(np.einsum('ij,ij->i', queries, queries))[:, None] + 1e-8)
+    scores = queries @ profile_matrix.T
     
-    for speaker_name, profile_embedding in profiles.items():
-        # Ensure profile embedding is 1D
-        profile_emb = np.array(profile_embedding)
-        if profile_emb.ndim > 1:
-            profile_emb = profile_emb.flatten()
-        
-        profile_norm = profile_emb / (np.linalg.norm(profile_emb) + 1e-8)
-        similarity = np.dot(embedding_norm, profile_norm)
-        
-        if similarity > best_score:
-            best_score = similarity
-            best_match = speaker_name
-    
-    return best_match, float(best_score)
+    # One argmax reduction per row; no match unless the best cosine is positive
+    best_indices = scores.argmax(axis=1)
+    best_scores = np.take_along_axis(scores, best_indices[:, None], axis=1)[:, 0]
+    matched = best_scores > 0.0
+    return [
+        (speaker_names[index], score) if ok else (None, 0.0)
+        for index, score, ok in zip(best_indices.tolist(), best_scores.tolist(), matched.tolist())
+    ]
 
 @app.route('/process', methods=['POST'])
 def process():
@@ -421,14 +634,14 @@ def process():
         print(f"Processing speaker identification for job {job_id}")
         
         # Load speaker profiles
-        profiles = load_speaker_profiles()
+        speaker_names, profile_matrix = load_speaker_profiles()
         
-        if len(profiles) == 0:
+        if len(speaker_names) == 0:
             return jsonify({
                 'error': 'No speaker profiles found. Please create speaker profiles from audio samples first using the "Create Profile from Audio Sample" feature in the Web UI.'
             }), 400
         
-        print(f"Loaded {len(profiles)} speaker profiles: {list(profiles.keys())}")
+        print(f"Loaded {len(speaker_names)} speaker profiles: {speaker_names}")
         
         # Get diarized segments
         segments = diarization_result.get('segments', [])
@@ -440,6 +653,16 @@ def process():
         if not os.path.exists(audio_path):
             return jsonify({'error': f'Audio file not found: {audio_file_id}'}), 404
         
+        # Decode the audio once; every speaker's segment is sliced from this
+        waveform, sample_rate = None, None
+        if SpeakerRecognition is not None:
+            try:
+                waveform, sample_rate = load_audio(audio_path)
+            except subprocess.CalledProcessError as e:
+                error_msg = f"FFmpeg conversion failed: {e.stderr.decode() if e.stderr else str(e)}"
+                print(f"ERROR: {error_msg}")
+                return jsonify({'error': error_msg}), 500
+        
         # Process each segment
         identified_segments = []
         speaker_mapping = {}
@@ -453,33 +676,42 @@ def process():
                 speaker_groups[speaker_id] = []
             speaker_groups[speaker_id].append(segment)
         
-        # Identify each unique diarized speaker
-        for speaker_id, group_segments in speaker_groups.items():
-            # Use the first segment to identify the speaker
-            first_segment = group_segments[0]
-            start_sec = first_segment.get('start', 0)
-            end_sec = first_segment.get('end', 0)
+        speaker_ids = list(speaker_groups)
+        
+        # Embed every unique diarized speaker in a single batched forward pass
+        if SpeakerRecognition is not None:
+            query_segments = []
+            for speaker_id in speaker_ids:
+                group_segments = speaker_groups[speaker_id]
+                print(f"Extracting embedding for {speaker_id} from up to {EMBEDDING_CLIP_SEC:.1f}s of its {len(group_segments)} segments")
+                segment = build_speaker_clip(waveform, sample_rate, group_segments)
+                if segment is None:
+                    error_msg = f'Failed to extract embedding for diarized speaker {speaker_id}: no usable segments'
+                    print(f"ERROR: {error_msg}")
+                    return jsonify({'error': error_msg}), 500
+                query_segments.append(segment)
+            
+            embeddings = encode_segments(query_segments, sample_rate)
+            if embeddings is None:
+                error_msg = f'Failed to extract embeddings for diarized speakers {speaker_ids}'
+                print(f"ERROR: {error_msg}")
+                return jsonify({'error': error_msg}), 500
             
+            print(f"Embeddings extracted (shape: {embeddings.shape}), matching against {len(speaker_names)} profiles...")
+            matches = match_speakers(embeddings, speaker_names, profile_matrix)
+        
+        # Identify each unique diarized speaker
+        for i, speaker_id in enumerate(speaker_ids):
             if SpeakerRecognition is None:
                 # Mock mode - simple mapping
                 speaker_name = f"Speaker_{speaker_id[-2:]}"
                 confidence = 0.85
             else:
-                # Extract embedding and match
-                print(f"Extracting embedding for {speaker_id} from segment {start_sec:.2f}s - {end_sec:.2f}s")
-                embedding = compute_speaker_embedding(audio_path, start_sec, end_sec)
-                
-                if embedding is None:
-                    error_msg = f'Failed to extract embedding for diarized speaker {speaker_id} from segment {start_sec:.2f}s - {end_sec:.2f}s'
-                    print(f"ERROR: {error_msg}")
-                    return jsonify({'error': error_msg}), 500
-                
-                print(f"Embedding extracted (shape: {embedding.shape if hasattr(embedding, 'shape') else 'unknown'}), matching against {len(profiles)} profiles...")
-                speaker_name, confidence = match_speaker(embedding, profiles)
+                speaker_name, confidence = matches[i]
                 print(f"Match result: {speaker_name} (confidence: {confidence:.3f})")
             
             if speaker_name is None:
-                available_profiles = list(profiles.keys())
+                available_profiles = list(speaker_names)
                 error_msg = f'Could not identify speaker for diarized speaker {speaker_id}. No matching profile found. Available profiles: {available_profiles}'
                 print(f"ERROR: {error_msg}")
                 return jsonify({'error': error_msg}), 500
@@ -531,7 +763,6 @@ def process():
     
     except Exception as e:
         print(f"Error in speaker identification: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -561,7 +792,9 @@ def create_profile():
             os.makedirs(CACHE_DIR, exist_ok=True)
         
         temp_audio_path = os.path.join(CACHE_DIR, f'temp_profile_{int(time.time())}_{secure_filename(audio_file.filename)}')
-        audio_file.save(temp_audio_path)
+        # Large buffers: FileStorage.save copies in 16 KiB chunks
+        with open(temp_audio_path, 'wb', buffering=UPLOAD_COPY_BUFFER_SIZE) as out:
+            shutil.copyfileobj(audio_file.stream, out, length=UPLOAD_COPY_BUFFER_SIZE)
         
         try:
             print(f"Creating profile for speaker: {speaker_name}")
@@ -615,9 +848,11 @@ def create_profile():
                 except:
                     pass
     
+    except RequestEntityTooLarge:
+        max_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+        return jsonify({'error': f'Audio file too large (limit {max_mb} MB)'}), 413
     except Exception as e:
         print(f"Error creating speaker profile: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
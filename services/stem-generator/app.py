@@ -1,12 +1,402 @@
 from flask import Flask, request, jsonify
 import os
+import mmap
+import struct
 import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+import numpy as np
+import soundfile as sf
 from pydub import AudioSegment
 
+# Optional: in-process libavcodec decode for compressed formats (mp3/m4a/aac)
+try:
+    import av
+except ImportError:
+    av = None
+
+# Optional: Numba-fused silence/speech fill for multichannel output
+try:
+    import numba
+    from numba import njit, prange
+    # The kernel runs from several gthread request threads at once, which
+    # aborts the process under the non-threadsafe workqueue layer
+    numba.config.THREADING_LAYER = 'threadsafe'
+except ImportError:
+    njit = None
+
 app = Flask(__name__)
 
 UPLOADS_DIR = '/app/uploads'
 OUTPUT_DIR = '/app/cache'  # Output pseudo-stems to cache (writable volume)
+SOUNDFILE_EXTENSIONS = {'.wav', '.flac'}  # Decoded by libsndfile directly
+WAV_HEADER_BYTES = 44
+WAV_FORMAT_PCM = 1
+WAV_FORMAT_EXTENSIBLE = 0xFFFE
+WAV_MAX_DATA_BYTES = 0xFFFFFFFF - 36  # Largest data chunk a RIFF header can describe
+NO_RANGES = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+SEGMENT_DTYPE = np.dtype([('sid', 'i4'), ('start', 'f8'), ('end', 'f8')])
+SEGMENT_FIELDS = itemgetter('speakerName', 'start', 'end')
+ZERO_BLOCK_FRAMES = 65536  # Frames of silence written per call when filling gaps
+zero_blocks = {}  # channels -> shared read-only zero block
+
+# Decoded sources kept across requests, keyed by (audioFileId, mtime, size)
+SOURCE_CACHE_MAX_BYTES = int(os.environ.get('STEM_SOURCE_CACHE_MB', '2048')) * 1024 * 1024
+source_cache = OrderedDict()
+source_cache_bytes = 0
+source_cache_lock = threading.Lock()
+
+def load_audio_with_pydub(audio_path):
+    """Decode any ffmpeg-readable format into an int16 (frames, channels) array"""
+    # Determine format from extension
+    audio_ext = os.path.splitext(audio_path)[1].lower()
+    if audio_ext == '.mp3':
+        audio = AudioSegment.from_mp3(audio_path)
+    elif audio_ext in ['.m4a', '.aac']:
+        audio = AudioSegment.from_file(audio_path, format='m4a')
+    else:
+        # Try to auto-detect format
+        audio = AudioSegment.from_file(audio_path)
+    
+    audio = audio.set_sample_width(2)
+    samples = np.frombuffer(audio.raw_data, dtype=np.int16).reshape(-1, audio.channels)
+    return samples, audio.frame_rate
+
+def load_audio_with_pyav(audio_path):
+    """Decode with PyAV (libavcodec in-process) into an int16 (frames, channels) array"""
+    with av.open(audio_path) as container:
+        stream = container.streams.audio[0]
+        channels = stream.codec_context.channels
+        # Packed s16 at the source rate and layout, so chunks are already interleaved int16
+        resampler = av.AudioResampler(format='s16', layout=stream.codec_context.layout, rate=stream.codec_context.sample_rate)
+        chunks = []
+        for frame in container.decode(stream):
+            for out_frame in resampler.resample(frame):
+                chunks.append(out_frame.to_ndarray())
+        for out_frame in resampler.resample(None):
+            chunks.append(out_frame.to_ndarray())
+        sample_rate = stream.codec_context.sample_rate
+    
+    if not chunks:
+        raise ValueError(f'No audio decoded from {audio_path}')
+    samples = np.concatenate(chunks, axis=1).reshape(-1, channels)
+    return samples, sample_rate
+
+def map_wav_pcm16(audio_path):
+    """Memory-map a 16-bit PCM WAV's data chunk as an int16 (frames, channels) view
+    
+    Pages are only read when a speech range touches them, so long sources cost
+    no RSS up front. Returns None for anything but plain 16-bit PCM.
+    """
+    with open(audio_path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[0:4] != b'RIFF' or mm[8:12] != b'WAVE':
+        mm.close()
+        return None
+    
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(mm):
+        chunk_id = mm[offset:offset + 4]
+        chunk_size, = struct.unpack_from('<I', mm, offset + 4)
+        body = offset + 8
+        if chunk_id == b'fmt ' and chunk_size >= 16:
+            fmt = list(struct.unpack_from('<HHIIHH', mm, body))
+            if fmt[0] == WAV_FORMAT_EXTENSIBLE and chunk_size >= 40:
+                # The real format tag leads the SubFormat GUID
+                fmt[0], = struct.unpack_from('<H', mm, body + 24)
+        elif chunk_id == b'data':
+            if fmt is None:
+                break
+            format_tag, channels, sample_rate, _, block_align, bits = fmt
+            if format_tag != WAV_FORMAT_PCM or bits != 16 or channels == 0 or block_align != channels * 2:
+                break
+            # Streamed writers leave the size at 0/0xFFFFFFFF; trust the file length instead
+            data_bytes = len(mm) - body
+            if chunk_size:
+                data_bytes = min(chunk_size, data_bytes)
+            frame_count = data_bytes // block_align
+            samples = np.frombuffer(mm, dtype='<i2', offset=body, count=frame_count * channels)
+            return samples.reshape(frame_count, channels), sample_rate
+        # Chunks are padded to an even length
+        offset = body + chunk_size + (chunk_size & 1)
+    mm.close()
+    return None
+
+def load_audio(audio_path):
+    """Load audio as (int16 samples of shape (frames, channels), sample_rate)"""
+    audio_ext = os.path.splitext(audio_path)[1].lower()
+    if audio_ext in SOUNDFILE_EXTENSIONS:
+        # libsndfile decodes straight into one ndarray, no ffmpeg or byte copies
+        try:
+            return sf.read(audio_path, dtype='int16', always_2d=True)
+        except RuntimeError as e:  # LibsndfileError: unsupported codec or damaged file
+            print(f"soundfile could not read {audio_path} ({e}), falling back")
+    if av is not None:
+        # No ffmpeg subprocess or WAV pipe; pydub stays as the last resort
+        try:
+            return load_audio_with_pyav(audio_path)
+        except Exception as e:
+            print(f"PyAV could not decode {audio_path} ({e}), falling back to pydub")
+    return load_audio_with_pydub(audio_path)
+
+def group_segments(identified_segments, duration_sec):
+    """Parse identified segments into {speaker_name: (N, 2) array of [start, end] seconds}
+    
+    Segments are parsed in one pass into a structured array and partitioned
+    per speaker with a stable sort; speakers keep first-appearance order.
+    """
+    name_to_id = {}
+    
+    def parse(rows):
+        return np.fromiter(
+            (
+                (name_to_id.setdefault(name, len(name_to_id)), start, end)
+                for name, start, end in rows
+                if name
+            ),
+            dtype=SEGMENT_DTYPE
+        )
+    
+    try:
+        # Diarization output always carries all three keys: one C-level lookup per segment
+        parsed = parse(map(SEGMENT_FIELDS, identified_segments))
+    except KeyError:
+        name_to_id.clear()
+        parsed = parse(
+            (segment.get('speakerName'), segment.get('start', 0), segment.get('end', duration_sec))
+            for segment in identified_segments
+        )
+    
+    parsed = parsed[np.argsort(parsed['sid'], kind='stable')]
+    speaker_ids, first_index = np.unique(parsed['sid'], return_index=True)
+    speaker_names = list(name_to_id)
+    return {
+        speaker_names[speaker_id]: np.column_stack((group['start'], group['end']))
+        for speaker_id, group in zip(speaker_ids.tolist(), np.split(parsed, first_index[1:]))
+    }
+
+def speech_frame_ranges(bounds, frame_count, sample_rate):
+    """Sorted, non-overlapping frame ranges of [start, end] second bounds, clipped to the audio
+    
+    Returns (range_starts, range_ends) int64 arrays.
+    """
+    if len(bounds) == 0:
+        return NO_RANGES
+    duration_sec = frame_count / sample_rate
+    
+    # Clip to the audio and convert every segment to frames in one pass
+    starts = (np.maximum(bounds[:, 0], 0) * sample_rate).astype(np.int64)
+    ends = (np.minimum(bounds[:, 1], duration_sec) * sample_rate).astype(np.int64)
+    keep = np.maximum(bounds[:, 0], 0) < np.minimum(bounds[:, 1], duration_sec)
+    starts, ends = starts[keep], ends[keep]
+    if len(starts) == 0:
+        return NO_RANGES
+    
+    # Coalesce overlapping/abutting segments so every frame is copied once: a
+    # new range begins wherever a start lies past every earlier end
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], np.maximum.accumulate(ends[order])
+    breaks = starts[1:] > ends[:-1]
+    return starts[np.concatenate(([True], breaks))], ends[np.concatenate((breaks, [True]))]
+
+def get_zero_block(channels):
+    """Shared read-only block of silence for the given channel count
+    
+    Allocated once per process and reused by every stem (and thread) for gap
+    writes instead of zeroing fresh memory per speaker.
+    """
+    zeros = zero_blocks.get(channels)
+    if zeros is None:
+        zeros = np.zeros((ZERO_BLOCK_FRAMES, channels), dtype=np.int16)
+        zeros.flags.writeable = False
+        zero_blocks[channels] = zeros
+    return zeros
+
+def write_silence(out, zeros, frame_count):
+    """Write frame_count frames of silence, reusing the zeros block"""
+    while frame_count > 0:
+        chunk = min(frame_count, len(zeros))
+        out.write(zeros[:chunk])
+        frame_count -= chunk
+
+def wav_header(frame_count, sample_rate, channels):
+    """44-byte canonical RIFF/WAVE header for 16-bit PCM"""
+    block_align = channels * 2
+    data_bytes = frame_count * block_align
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_bytes, b'WAVE',
+        b'fmt ', 16, 1, channels, sample_rate, sample_rate * block_align, block_align, 16,
+        b'data', data_bytes
+    )
+
+def write_stem(speaker_name, segments, samples, sample_rate, job_id):
+    """Write one speaker's pseudo-stem WAV and return its filename
+    
+    The stem has the source audio inside the speaker's segments and silence
+    everywhere else, over the full duration of the source. Returns None
+    without writing anything when no segment overlaps the audio.
+    """
+    frame_count, channels = samples.shape
+    ranges = speech_frame_ranges(segments, frame_count, sample_rate)
+    if len(ranges[0]) == 0:
+        return None
+    
+    output_filename = f'stem_{job_id}_{speaker_name}.wav'
+    output_path = os.path.join(OUTPUT_DIR, output_filename)
+    
+    if frame_count * channels * 2 > WAV_MAX_DATA_BYTES:
+        # Too big for a plain RIFF header; let libsndfile pick RF64
+        write_stem_streaming(output_path, ranges, samples, sample_rate)
+        return output_filename
+    
+    # Header, then each speech range written straight from the source buffer
+    # with a seek over every gap: the gaps stay sparse and read back as zeros,
+    # and the file is filled in one forward pass with no intermediate copies
+    # (one write per range; seek flushes, so a bigger buffer would not merge them)
+    range_starts, range_ends = ranges
+    frame_bytes = channels * 2
+    with open(output_path, 'wb') as f:
+        f.write(wav_header(frame_count, sample_rate, channels))
+        for start_frame, end_frame in zip(range_starts.tolist(), range_ends.tolist()):
+            f.seek(WAV_HEADER_BYTES + start_frame * frame_bytes)
+            f.write(samples[start_frame:end_frame])
+        f.truncate(WAV_HEADER_BYTES + frame_count * frame_bytes)
+    
+    return output_filename
+
+def write_multichannel_stem(speaker_segment_map, samples, sample_rate, job_id):
+    """Write every speaker's pseudo-stem into one interleaved WAV
+    
+    Speaker k occupies channels [k * C, (k + 1) * C) where C is the source
+    channel count. Returns (filename, {speaker_name: first channel}), leaving
+    out speakers with no speech inside the audio.
+    """
+    frame_count, channels = samples.shape
+    speaker_ranges = {}
+    for speaker_name, segments in speaker_segment_map.items():
+        ranges = speech_frame_ranges(segments, frame_count, sample_rate)
+        if len(ranges[0]):
+            speaker_ranges[speaker_name] = ranges
+    if not speaker_ranges:
+        return None, {}
+    
+    output_filename = f'stems_{job_id}.wav'
+    output_path = os.path.join(OUTPUT_DIR, output_filename)
+    out_channels = len(speaker_ranges) * channels
+    
+    if frame_count * out_channels * 2 > WAV_MAX_DATA_BYTES:
+        out = sf.SoundFile(output_path, 'w', samplerate=sample_rate, channels=out_channels, subtype='PCM_16', format='RF64')
+    else:
+        out = open(output_path, 'wb')
+        out.write(wav_header(frame_count, sample_rate, out_channels))
+    
+    # Every speaker's ranges back to back, speaker k's at [offsets[k], offsets[k + 1])
+    all_starts = np.concatenate([ranges[0] for ranges in speaker_ranges.values()])
+    all_ends = np.concatenate([ranges[1] for ranges in speaker_ranges.values()])
+    offsets = np.cumsum([0] + [len(ranges[0]) for ranges in speaker_ranges.values()]).astype(np.int64)
+    
+    # One pass over the output in blocks
+    block = np.empty((ZERO_BLOCK_FRAMES, len(speaker_ranges), channels), dtype=np.int16)
+    with out:
+        for block_start in range(0, frame_count, ZERO_BLOCK_FRAMES):
+            block_end = min(block_start + ZERO_BLOCK_FRAMES, frame_count)
+            frames = block[:block_end - block_start]
+            if gate_block_kernel is not None:
+                # Silence and speech written in the same pass, each sample once
+                gate_block_kernel(frames, samples, block_start, all_starts, all_ends, offsets)
+                out.write(frames.reshape(len(frames), out_channels))
+                continue
+            # Each block starts silent and gets the speech ranges that
+            # overlap it copied into the speaker's channels
+            frames.fill(0)
+            for k, (range_starts, range_ends) in enumerate(speaker_ranges.values()):
+                # Merged ranges are sorted by both start and end
+                first = np.searchsorted(range_ends, block_start, side='right')
+                last = np.searchsorted(range_starts, block_end, side='left')
+                for start_frame, end_frame in zip(range_starts[first:last].tolist(), range_ends[first:last].tolist()):
+                    start_frame = max(start_frame, block_start)
+                    end_frame = min(end_frame, block_end)
+                    frames[start_frame - block_start:end_frame - block_start, k] = samples[start_frame:end_frame]
+            out.write(frames.reshape(len(frames), out_channels))
+    
+    return output_filename, {name: k * channels for k, name in enumerate(speaker_ranges)}
+
+def write_stem_streaming(output_path, ranges, samples, sample_rate):
+    """Stream a stem through libsndfile: speech from views of the source, gaps from a shared zero block"""
+    frame_count, channels = samples.shape
+    zeros = get_zero_block(channels)
+    with sf.SoundFile(output_path, 'w', samplerate=sample_rate, channels=channels, subtype='PCM_16', format='RF64') as out:
+        cursor = 0
+        for start_frame, end_frame in zip(*(r.tolist() for r in ranges)):
+            write_silence(out, zeros, start_frame - cursor)
+            out.write(samples[start_frame:end_frame])
+            cursor = end_frame
+        write_silence(out, zeros, frame_count - cursor)
+
+def load_source(audio_file_id, audio_path):
+    """Decoded source samples for a request, from the LRU cache when unchanged on disk"""
+    global source_cache_bytes
+    st = os.stat(audio_path)
+    key = (audio_file_id, st.st_mtime_ns, st.st_size)
+    
+    with source_cache_lock:
+        cached = source_cache.get(key)
+        if cached is not None:
+            source_cache.move_to_end(key)
+            return cached
+    
+    if os.path.splitext(audio_path)[1].lower() == '.wav' and st.st_size:
+        # Mapping is O(1) and the page cache already shares it, so no need to cache
+        mapped = map_wav_pcm16(audio_path)
+        if mapped is not None:
+            return mapped
+    
+    samples, sample_rate = load_audio(audio_path)
+    # One C-contiguous int16 buffer: every speech range written from it is a
+    # single contiguous block handed to libsndfile with no conversion copy
+    samples = np.ascontiguousarray(samples, dtype=np.int16)
+    # Shared between requests and threads, so never written to
+    samples.flags.writeable = False
+    
+    if samples.nbytes <= SOURCE_CACHE_MAX_BYTES:
+        with source_cache_lock:
+            if key not in source_cache:
+                source_cache[key] = (samples, sample_rate)
+                source_cache_bytes += samples.nbytes
+                while source_cache_bytes > SOURCE_CACHE_MAX_BYTES:
+                    _, (evicted, _) = source_cache.popitem(last=False)
+                    source_cache_bytes -= evicted.nbytes
+    return samples, sample_rate
+
+gate_block_kernel = None
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def gate_block_kernel(frames, src, block_start, range_starts, range_ends, offsets):
+        # frames[i, k] = src[block_start + i] inside speaker k's ranges, else 0;
+        # ranges are sorted, so one pointer walks them alongside the frames
+        for k in prange(offsets.size - 1):
+            j = offsets[k] + np.searchsorted(range_ends[offsets[k]:offsets[k + 1]], block_start, side='right')
+            for i in range(frames.shape[0]):
+                frame = block_start + i
+                while j < offsets[k + 1] and range_ends[j] <= frame:
+                    j += 1
+                if j < offsets[k + 1] and range_starts[j] <= frame:
+                    frames[i, k, :] = src[frame, :]
+                else:
+                    frames[i, k, :] = 0
+    
+    # Compile at import (for the read-only shared source arrays) rather than on the first request
+    try:
+        _src = np.zeros((2, 1), dtype=np.int16)
+        _src.flags.writeable = False
+        gate_block_kernel(np.empty((2, 1, 1), dtype=np.int16), _src, 0, np.zeros(1, np.int64), np.ones(1, np.int64), np.array([0, 1], np.int64))
+    except Exception as e:
+        print(f"Numba gate kernel unavailable, using slice copies: {e}")
+        gate_block_kernel = None
 
 @app.route('/health', methods=['GET'])
 def health():
@@ -25,6 +415,8 @@ def process():
         job_id = data.get('jobId')
         audio_file_id = data.get('audioFileId')
         speaker_segments = data.get('speakerSegments', {})
+        # One interleaved WAV for all speakers instead of a file per speaker
+        multichannel = bool(data.get('multichannel', False))
         
         if not audio_file_id:
             return jsonify({'error': 'audioFileId is required'}), 400
@@ -39,73 +431,49 @@ def process():
         if not os.path.exists(audio_path):
             return jsonify({'error': f'Audio file not found: {audio_file_id}'}), 404
         
-        # Load audio and get properties (pydub can handle multiple formats)
-        # Determine format from extension
-        audio_ext = os.path.splitext(audio_path)[1].lower()
-        if audio_ext == '.wav':
-            audio = AudioSegment.from_wav(audio_path)
-        elif audio_ext == '.mp3':
-            audio = AudioSegment.from_mp3(audio_path)
-        elif audio_ext in ['.m4a', '.aac']:
-            audio = AudioSegment.from_file(audio_path, format='m4a')
-        else:
-            # Try to auto-detect format
-            audio = AudioSegment.from_file(audio_path)
-        
-        sample_rate = audio.frame_rate
-        duration_ms = len(audio)
-        duration_sec = duration_ms / 1000.0
+        samples, sample_rate = load_source(audio_file_id, audio_path)
+        frame_count = len(samples)
+        duration_sec = frame_count / sample_rate
         
         print(f"Loaded audio: {duration_sec:.2f}s, {sample_rate}Hz")
         
         # Group segments by speaker name
-        speaker_segment_map = {}
         identified_segments = speaker_segments.get('identifiedSegments', [])
+        speaker_segment_map = group_segments(identified_segments, duration_sec)
         
-        for segment in identified_segments:
-            speaker_name = segment.get('speakerName')
-            if not speaker_name:
-                continue
-            
-            if speaker_name not in speaker_segment_map:
-                speaker_segment_map[speaker_name] = []
-            
-            speaker_segment_map[speaker_name].append({
-                'start': segment.get('start', 0),
-                'end': segment.get('end', duration_sec)
+        if multichannel:
+            output_filename, stem_channels = write_multichannel_stem(speaker_segment_map, samples, sample_rate, job_id)
+            print(f"Generated multichannel pseudo-stem: {output_filename} ({len(stem_channels)} speakers)")
+            return jsonify({
+                'jobId': job_id,
+                'multichannelStem': output_filename,
+                'stemChannels': stem_channels,
+                'channelsPerStem': samples.shape[1],
+                'sampleRate': sample_rate,
+                'duration': duration_sec,
+                'processedAt': time.time()
             })
         
         # Generate one WAV per speaker
         output_stems = {}
         
-        for speaker_name, segments in speaker_segment_map.items():
-            # Start with silence for the full duration
-            speaker_audio = AudioSegment.silent(duration=duration_ms, frame_rate=sample_rate)
-            
-            # Overlay original audio in assigned segments
-            for segment in segments:
-                start_sec = max(0, segment['start'])
-                end_sec = min(duration_sec, segment['end'])
-                
-                if start_sec >= end_sec:
+        # Speakers are independent and NumPy/libsndfile release the GIL, so
+        # threads share the read-only source array without copying it
+        max_workers = min(len(speaker_segment_map), os.cpu_count() or 1) or 1
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(write_stem, speaker_name, segments, samples, sample_rate, job_id): speaker_name
+                for speaker_name, segments in speaker_segment_map.items()
+            }
+            # Collect in submission order so the stems map stays in speaker order
+            for future, speaker_name in futures.items():
+                output_filename = future.result()
+                if output_filename is None:
+                    # All of the speaker's segments fall outside the audio
+                    print(f"Skipping pseudo-stem for {speaker_name}: no speech within the audio")
                     continue
-                
-                start_ms = int(start_sec * 1000)
-                end_ms = int(end_sec * 1000)
-                
-                # Extract the segment from original audio
-                audio_segment = audio[start_ms:end_ms]
-                
-                # Overlay onto the silent base
-                speaker_audio = speaker_audio.overlay(audio_segment, position=start_ms)
-            
-            # Export the pseudo-stem
-            output_filename = f'stem_{job_id}_{speaker_name}.wav'
-            output_path = os.path.join(OUTPUT_DIR, output_filename)
-            speaker_audio.export(output_path, format='wav')
-            
-            output_stems[speaker_name] = output_filename
-            print(f"Generated pseudo-stem for {speaker_name}: {output_filename}")
+                output_stems[speaker_name] = output_filename
+                print(f"Generated pseudo-stem for {speaker_name}: {output_filename}")
         
         result = {
             'jobId': job_id,
@@ -270,7 +270,7 @@ app.get('/api/profiles', (req, res) => {
   try {
     const files = fs.readdirSync(PROFILES_DIR);
     const profiles = files
-      .filter(f => f.endsWith('.pkl') || f.endsWith('.json'))
+      .filter(f => f.endsWith('.npy') || f.endsWith('.pkl') || (f.endsWith('.json') && !f.endsWith('.meta.json')))
       .map(f => {
         const speakerName = path.parse(f).name;
         const filePath = path.join(PROFILES_DIR, f);
@@ -294,12 +294,18 @@ app.delete('/api/profiles/:speakerName', (req, res) => {
   try {
     const speakerName = req.params.speakerName;
     
-    // Try both .pkl and .json extensions
+    // Try .npy (plus its .meta.json sidecar), .pkl and .json extensions
     let deleted = false;
-    for (const ext of ['.pkl', '.json']) {
+    for (const ext of ['.npy', '.pkl', '.json']) {
       const profilePath = path.join(PROFILES_DIR, `${speakerName}${ext}`);
       if (fs.existsSync(profilePath)) {
         fs.unlinkSync(profilePath);
+        if (ext === '.npy') {
+          const metaPath = path.join(PROFILES_DIR, `${speakerName}.meta.json`);
+          if (fs.existsSync(metaPath)) {
+            fs.unlinkSync(metaPath);
+          }
+        }
         deleted = true;
         break;
       }